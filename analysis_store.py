@@ -0,0 +1,102 @@
+"""
+Persistent store of finished analyses keyed by their download filename.
+
+A job's averages come from a player_averages.PlayerAggregate, which
+serializes to a few hundred bytes per player. Storing it with the battle
+summary is enough to render the averages workbook again on any later
+download, so workbooks no longer have to be kept on disk and downloads
+outlive restarts on hosts whose disk is wiped. The analyses live in the
+same SQLite file as the battle store by default.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from battle_store import BATTLE_STORE_PATH
+from player_averages import PlayerAggregate
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_STORE_PATH = os.getenv('ANALYSIS_STORE_PATH', BATTLE_STORE_PATH)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    filename TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    players INTEGER NOT NULL,
+    aggregate TEXT NOT NULL,
+    battle_summary TEXT
+)
+"""
+
+
+class AnalysisStore:
+    """SQLite-backed store of analysis aggregates and battle summaries"""
+
+    def __init__(self, path=ANALYSIS_STORE_PATH):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(SCHEMA)
+
+    def _connection(self):
+        # sqlite3 connections may not be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def put(self, filename, aggregate, battle_summary=None):
+        """Store an analysis's aggregate and battle summary under its download filename"""
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO analyses (filename, created_at, players, aggregate, battle_summary) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (filename, time.time(), len(aggregate), aggregate.serialize(),
+                 json.dumps(battle_summary) if battle_summary is not None else None)
+            )
+
+    def get(self, filename):
+        """Return the stored (aggregate, battle_summary) for filename, or None"""
+        row = self._connection().execute(
+            'SELECT aggregate, battle_summary FROM analyses WHERE filename = ?', (filename,)
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            aggregate = PlayerAggregate.deserialize(row[0])
+        except ValueError as e:
+            logger.warning(f"Stored analysis {filename} can't be read: {str(e)}")
+            return None
+        return aggregate, json.loads(row[1]) if row[1] else None
+
+    def list(self):
+        """Return filename, creation time and player count of every stored analysis, newest first"""
+        rows = self._connection().execute(
+            'SELECT filename, created_at, players FROM analyses ORDER BY created_at DESC'
+        ).fetchall()
+        return [{'filename': filename, 'created_at': created_at, 'players': players}
+                for filename, created_at, players in rows]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_analysis_store():
+    """Return the process-wide analysis store"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = AnalysisStore()
+        return _store
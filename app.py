@@ -3,12 +3,22 @@ eventlet.monkey_patch()
 
 from flask import Flask, render_template, request, jsonify, send_file, current_app
 from flask_socketio import SocketIO, emit
-from battle_scraper import setup_driver, extract_battle_data_with_retry, calculate_averages, save_averages_to_excel, create_driver
+from battle_scraper import save_averages_to_excel
+from battle_runner import run_battle_job
+from driver_pool import get_driver_pool
+import metrics
+from rate_limiter import get_rate_limiter
+from concurrency_controller import get_concurrency_controller
+from battle_record import records_to_dicts
+from player_averages import PlayerAggregate
+from analysis_store import get_analysis_store
+from excel_export import render_averages_workbook
 import threading
 import queue
 import logging
 import os
 import json
+import time
 from datetime import datetime
 
 # Configure logging
@@ -27,9 +37,17 @@ battle_queue = queue.Queue()
 
 # Store for analyses
 ANALYSES_DIR = 'analyses'
+# Set to 1 to also write each analysis workbook to ANALYSES_DIR; downloads are rendered from the stored aggregate
+PERSIST_ANALYSES = os.getenv('PERSIST_ANALYSES', '0') != '0'
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# Seconds between live averages_update events while a job runs
+AVERAGES_UPDATE_INTERVAL = float(os.getenv('AVERAGES_UPDATE_INTERVAL', '1'))
 if not os.path.exists(ANALYSES_DIR):
     os.makedirs(ANALYSES_DIR)
 
+# Warm the shared Chrome driver pool so the first job skips the browser boot
+driver_pool = get_driver_pool()
+
 @app.route('/')
 def index():
     logger.info("Accessing index page")
@@ -48,39 +66,52 @@ def process_battles():
     
     return jsonify({'message': 'Processing started'})
 
-@app.route('/download/<filename>')
-def download_file(filename):
-    try:
-        file_path = os.path.join(ANALYSES_DIR, filename)
+def send_analysis(filename):
+    """Send an analysis workbook, rendered in memory from the stored aggregate or read from ANALYSES_DIR"""
+    filename = os.path.basename(filename)
+    stored = get_analysis_store().get(filename)
+    if stored is not None:
+        aggregate, battle_summary = stored
+        # Sent in chunks straight from the buffer; nothing is written to disk
         return send_file(
-            file_path,
+            render_averages_workbook(aggregate.finalize(), battle_summary),
             as_attachment=True,
             download_name=filename,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            mimetype=XLSX_MIMETYPE
         )
+    # Workbooks saved before analyses were stored, or with PERSIST_ANALYSES
+    return send_file(
+        os.path.join(ANALYSES_DIR, filename),
+        as_attachment=True,
+        download_name=filename,
+        mimetype=XLSX_MIMETYPE
+    )
+
+@app.route('/download/<filename>')
+def download_file(filename):
+    try:
+        return send_analysis(filename)
     except Exception as e:
         return jsonify({'error': str(e)}), 404
 
 @app.route('/download_averages/<filename>')
 def download_averages(filename):
     try:
-        # The file is already saved with the correct name, no need to modify it
-        file_path = os.path.join(ANALYSES_DIR, filename)
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        return send_analysis(filename)
     except Exception as e:
         logger.error(f"Error downloading file: {str(e)}")
         return jsonify({'error': str(e)}), 404
 
 @app.route('/previous_analyses')
 def get_previous_analyses():
-    analyses = []
+    analyses = [{
+        'filename': analysis['filename'],
+        'date': datetime.fromtimestamp(analysis['created_at']).strftime('%Y-%m-%d %H:%M:%S'),
+        'players': analysis['players']
+    } for analysis in get_analysis_store().list()]
+    stored = {analysis['filename'] for analysis in analyses}
     for filename in os.listdir(ANALYSES_DIR):
-        if filename.endswith('.xlsx'):
+        if filename.endswith('.xlsx') and filename not in stored:
             file_path = os.path.join(ANALYSES_DIR, filename)
             analyses.append({
                 'filename': filename,
@@ -89,100 +120,112 @@ def get_previous_analyses():
             })
     return jsonify(analyses)
 
+@app.route('/metrics')
+def get_metrics():
+    data = metrics.snapshot()
+    data['driver_pool'] = driver_pool.stats()
+    data['rate_limits'] = get_rate_limiter().status()
+    data['concurrency'] = get_concurrency_controller().status()
+    return jsonify(data)
+
 def process_battle_urls(urls):
     logger.info(f"Starting to process {len(urls)} battle URLs")
-    all_battles_data = []
-    victories = 0
-    defeats = 0
+    total_battles = len(urls)
+    # Averages are kept up to date as battles arrive, so no pass over all battles is needed at the end
+    aggregate = PlayerAggregate()
+    live = {'changed': set(), 'last_emit': 0.0}
+    
+    def emit_averages_update(force=False):
+        # Throttled: players changed since the last update are sent together
+        if not live['changed'] or (not force and time.time() - live['last_emit'] < AVERAGES_UPDATE_INTERVAL):
+            return
+        rows = aggregate.finalize(live['changed'])
+        live['changed'] = set()
+        live['last_emit'] = time.time()
+        socketio.emit('averages_update', {
+            'averages': rows,
+            'players': len(aggregate)
+        }, namespace='/')
+    
+    def emit_battle_result(i, url, is_victory, battle_data, error):
+        # Called in URL order even though battles finish out of order
+        progress = (i / total_battles) * 100
+        socketio.emit('progress', {
+            'current': i,
+            'total': total_battles,
+            'percentage': progress,
+            'url': url
+        }, namespace='/')
+        
+        if error is not None:
+            logger.error(f"Error processing battle {i}: {str(error)}")
+            socketio.emit('battle_processed', {
+                'url': url,
+                'result': 'Error',
+                'stats': []
+            }, namespace='/')
+        elif battle_data:
+            # Emit battle result with full stats
+            logger.info(f"Battle {i}/{total_battles} processed successfully")
+            socketio.emit('battle_processed', {
+                'url': url,
+                'result': 'Victory' if is_victory else 'Defeat' if is_victory is not None else 'Unknown',
+                'stats': records_to_dicts(battle_data)
+            }, namespace='/')
+            live['changed'].update(aggregate.add_battle(battle_data))
+            emit_averages_update()
+        else:
+            logger.warning(f"No data extracted for battle {i}: {url}")
+            socketio.emit('battle_processed', {
+                'url': url,
+                'result': 'Unknown',
+                'stats': []
+            }, namespace='/')
     
     # Create application context
     with app.app_context():
         try:
-            with create_driver() as driver:
-                logger.info("WebDriver setup complete")
+            all_battles_data, victories, defeats = run_battle_job(urls, on_result=emit_battle_result, pool=driver_pool)
+            
+            if all_battles_data:
+                logger.info("Processing complete, sending final averages")
+                emit_averages_update(force=True)
+                averages_data = aggregate.finalize()
                 
-                total_battles = len(urls)
-                for i, url in enumerate(urls, 1):
-                    try:
-                        # Emit progress update
-                        progress = (i / total_battles) * 100
-                        logger.info(f"Processing battle {i}/{total_battles}: {url}")
-                        socketio.emit('progress', {
-                            'current': i,
-                            'total': total_battles,
-                            'percentage': progress,
-                            'url': url
-                        }, namespace='/')
-                        
-                        is_victory, battle_data = extract_battle_data_with_retry(driver, url)
-                        if battle_data:
-                            all_battles_data.append(battle_data)
-                            if is_victory is not None:
-                                if is_victory:
-                                    victories += 1
-                                else:
-                                    defeats += 1
-                            
-                            # Emit battle result with full stats
-                            logger.info(f"Battle {i} processed successfully")
-                            socketio.emit('battle_processed', {
-                                'url': url,
-                                'result': 'Victory' if is_victory else 'Defeat' if is_victory is not None else 'Unknown',
-                                'stats': battle_data
-                            }, namespace='/')
-                        else:
-                            logger.warning(f"No data extracted for battle {i}: {url}")
-                            socketio.emit('battle_processed', {
-                                'url': url,
-                                'result': 'Unknown',
-                                'stats': []
-                            }, namespace='/')
-                        
-                    except Exception as e:
-                        logger.error(f"Error processing battle {i}: {str(e)}")
-                        socketio.emit('battle_processed', {
-                            'url': url,
-                            'result': 'Error',
-                            'stats': []
-                        }, namespace='/')
+                # Add battle summary to averages data
+                battle_summary = {
+                    'victories': victories,
+                    'defeats': defeats,
+                    'total_battles': len(all_battles_data),
+                    'win_rate': (victories / (victories + defeats) * 100) if victories + defeats > 0 else 0
+                }
                 
-                if all_battles_data:
-                    logger.info("Processing complete, calculating averages")
-                    # Calculate averages
-                    averages_data = calculate_averages(all_battles_data)
-                    
-                    # Add battle summary to averages data
-                    battle_summary = {
-                        'victories': victories,
-                        'defeats': defeats,
-                        'total_battles': len(all_battles_data),
-                        'win_rate': (victories / (victories + defeats) * 100) if victories + defeats > 0 else 0
-                    }
-                    
-                    # Generate unique filename with timestamp
-                    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                    excel_filename = f"battle_stats_{timestamp}.xlsx"
+                # Generate unique filename with timestamp
+                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+                excel_filename = f"battle_stats_{timestamp}.xlsx"
+                
+                # Store the aggregate; the workbook is rendered from it when downloaded
+                get_analysis_store().put(excel_filename, aggregate, battle_summary)
+                if PERSIST_ANALYSES:
                     excel_path = os.path.join(ANALYSES_DIR, excel_filename)
-                    
-                    # Save averages Excel file with battle summary
                     logger.info(f"Saving averages to {excel_path}")
                     save_averages_to_excel(averages_data, excel_path, battle_summary)
-                    
-                    # Emit final results with averages
-                    logger.info("Emitting final results")
-                    socketio.emit('processing_complete', {
-                        'victories': victories,
-                        'defeats': defeats,
-                        'total_battles': len(all_battles_data),
-                        'win_rate': (victories / (victories + defeats) * 100) if victories + defeats > 0 else 0,
-                        'averages': averages_data,
-                        'excel_file': excel_filename  # This is now the correct filename
-                    }, namespace='/')
-                else:
-                    logger.error("No battle data was extracted from any battle")
-                    socketio.emit('processing_error', {
-                        'message': 'No battle data was extracted from any battle'
-                    }, namespace='/')
+                
+                # Emit final results with averages
+                logger.info("Emitting final results")
+                socketio.emit('processing_complete', {
+                    'victories': victories,
+                    'defeats': defeats,
+                    'total_battles': len(all_battles_data),
+                    'win_rate': (victories / (victories + defeats) * 100) if victories + defeats > 0 else 0,
+                    'averages': averages_data,
+                    'excel_file': excel_filename  # This is now the correct filename
+                }, namespace='/')
+            else:
+                logger.error("No battle data was extracted from any battle")
+                socketio.emit('processing_error', {
+                    'message': 'No battle data was extracted from any battle'
+                }, namespace='/')
             
         except Exception as e:
             logger.error(f"Error processing battles: {str(e)}")
@@ -0,0 +1,320 @@
+"""
+Browserless fetch backend for tomato.gg battle pages.
+
+Battle data is fetched with a pooled requests.Session, either from the JSON
+embedded in the page (__NEXT_DATA__) or from a battle data endpoint. Callers
+fall back to the Selenium path whenever this backend cannot produce data.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from battle_parser import parse_battle_scoreboard
+from battle_record import BattleRecord
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = "https://tomato.gg"
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+# Fast path configuration
+HTTP_FAST_PATH = os.getenv('HTTP_FAST_PATH', '1') != '0'
+# Optional battle data endpoint, e.g. "https://example/api/battle/{battle_id}/{player_id}"
+BATTLE_API_URL = os.getenv('TOMATO_BATTLE_API_URL', '')
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '10'))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '20'))
+# After this many failed fetches in a row (refused, errored or without usable data) the fast path
+# pauses for HTTP_RETRY_INTERVAL seconds
+HTTP_MISS_LIMIT = 5
+HTTP_RETRY_INTERVAL = 600
+
+BATTLE_URL_PATTERN = re.compile(r'/battle/(\d+)/(\d+)')
+NEXT_DATA_PATTERN = re.compile(
+    r'<script[^>]*id="__NEXT_DATA__"[^>]*>(.*?)</script>', re.DOTALL
+)
+
+# Accepted key spellings for each stat in battle JSON payloads
+FIELD_ALIASES = {
+    'name': ('name', 'username', 'nickname', 'playerName', 'player_name'),
+    'clan': ('clan', 'clanTag', 'clan_tag', 'clanAbbreviation'),
+    'tank': ('tank', 'tankName', 'tank_name', 'vehicle', 'vehicleName', 'shortName', 'short_name'),
+    'damage': ('damage', 'damageDealt', 'damage_dealt'),
+    'frags': ('frags', 'kills'),
+    'assist': ('assist', 'damageAssisted', 'damage_assisted', 'assisted'),
+    'spots': ('spots', 'spotted'),
+    'shots': ('shots',),
+    'hits': ('hits', 'directHits', 'direct_hits'),
+    'pens': ('pens', 'piercings', 'penetrations'),
+    'survival': ('lifeTime', 'lifetime', 'life_time', 'survival', 'survivalTime'),
+    'xp': ('xp', 'exp', 'experience'),
+    'player_id': ('playerId', 'player_id', 'accountId', 'account_id', 'id'),
+    'team': ('team', 'teamId', 'team_id'),
+}
+
+
+class FastPathUnavailable(Exception):
+    """Raised when battle data cannot be obtained without a browser"""
+
+
+class FastPathRateLimited(FastPathUnavailable):
+    """Raised when tomato.gg answered 429; retry_after is in seconds if the server gave one"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_battle_url(url):
+    """Return (battle_id, player_id) from a tomato.gg battle URL, or (None, None)"""
+    match = BATTLE_URL_PATTERN.search(url or '')
+    if not match:
+        return None, None
+    return match.group(1), match.group(2)
+
+
+def _lookup(record, field):
+    for key in FIELD_ALIASES[field]:
+        if key in record and record[key] is not None:
+            return record[key]
+    return None
+
+
+def _format_survival(value):
+    if value is None:
+        return ''
+    if isinstance(value, str) and ':' in value:
+        return value.strip()
+    try:
+        seconds = int(float(value))
+    except (TypeError, ValueError):
+        return str(value)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+def _looks_like_player(record):
+    return isinstance(record, dict) and _lookup(record, 'name') is not None and _lookup(record, 'damage') is not None
+
+
+def _find_player_list(payload, parent=None):
+    """Depth-first search for the first list of player-like dicts in a payload
+
+    Returns (players, container) where container is the dict holding the list,
+    since that is where battle-level fields such as the winning team live.
+    """
+    if isinstance(payload, list):
+        if payload and all(_looks_like_player(item) for item in payload):
+            return payload, parent
+        items = payload
+    elif isinstance(payload, dict):
+        parent = payload
+        items = payload.values()
+    else:
+        return None, None
+    for item in items:
+        found, container = _find_player_list(item, parent)
+        if found:
+            return found, container
+    return None, None
+
+
+def payload_player_to_stats(record):
+    """Map one player object from a battle JSON payload to a stats record"""
+    name = str(_lookup(record, 'name') or '').strip()
+    clan = _lookup(record, 'clan')
+    if clan:
+        # Match the rendered table, which shows the clan tag under the name
+        name = f"{name}\n[{str(clan).strip('[]')}]"
+
+    tank = _lookup(record, 'tank')
+    if isinstance(tank, dict):
+        tank = tank.get('name') or tank.get('short_name') or tank.get('shortName')
+
+    shots, hits, pens = (_lookup(record, field) for field in ('shots', 'hits', 'pens'))
+    accuracy = f"{shots}/{hits}/{pens}" if shots is not None and hits is not None and pens is not None else ''
+
+    return BattleRecord(
+        name=name,
+        tank=str(tank or '').strip(),
+        damage=_lookup(record, 'damage'),
+        frags=_lookup(record, 'frags'),
+        assist=_lookup(record, 'assist'),
+        spots=_lookup(record, 'spots'),
+        accuracy=accuracy,
+        survival=_format_survival(_lookup(record, 'survival')),
+        xp=_lookup(record, 'xp')
+    )
+
+
+def _payload_result(payload, players, player_id):
+    """Work out victory/defeat for player_id from a battle payload, or None"""
+    if isinstance(payload, dict):
+        for key in ('result', 'battleResult'):
+            value = payload.get(key)
+            if isinstance(value, str) and value.lower() in ('win', 'victory', 'loss', 'defeat'):
+                return value.lower() in ('win', 'victory')
+        winner = payload.get('winnerTeam', payload.get('winner_team'))
+        if winner is not None and player_id is not None:
+            for record in players:
+                if str(_lookup(record, 'player_id')) == str(player_id):
+                    team = _lookup(record, 'team')
+                    return None if team is None else str(team) == str(winner)
+    return None
+
+
+def battle_payload_to_records(payload, player_id=None):
+    """Convert a battle JSON payload to (is_victory, battle_data)"""
+    players, container = _find_player_list(payload)
+    if not players:
+        return None, []
+    battle_data = [
+        stats for stats in (payload_player_to_stats(record) for record in players)
+        if stats.name and stats.tank
+    ]
+    is_victory = _payload_result(container, players, player_id)
+    if is_victory is None and container is not payload:
+        is_victory = _payload_result(payload, players, player_id)
+    return is_victory, battle_data
+
+
+def battle_payload_to_scoreboard(payload, battle_id=None, player_id=None):
+    """Convert a battle JSON payload to a scoreboard (see battle_parser.build_scoreboard)
+
+    Raises FastPathUnavailable when the payload does not say which team the
+    player was on, since the player's own team can't be told from the enemy.
+    """
+    players, container = _find_player_list(payload)
+    if not players:
+        return None
+    is_victory, battle_data = battle_payload_to_records(payload, player_id)
+
+    # Split into teams, the requested player's team first
+    own_team = None
+    for record in players:
+        if player_id is not None and str(_lookup(record, 'player_id')) == str(player_id):
+            own_team = _lookup(record, 'team')
+    if own_team is None:
+        # Both teams in one table would mix enemy players into the averages
+        raise FastPathUnavailable(f"Battle payload does not say which team player {player_id} was on")
+    teams = [{'player_ids': [], 'battle_data': []}, {'player_ids': [], 'battle_data': []}]
+    for record in players:
+        stats = payload_player_to_stats(record)
+        if not (stats.name and stats.tank):
+            continue
+        team = teams[0] if str(_lookup(record, 'team')) == str(own_team) else teams[1]
+        team['battle_data'].append(stats)
+        if _lookup(record, 'player_id') is not None:
+            team['player_ids'].append(str(_lookup(record, 'player_id')))
+
+    return {'battle_id': battle_id, 'player_id': player_id, 'is_victory': is_victory, 'teams': teams}
+
+
+class HttpBattleFetcher:
+    """Fetches battle data over plain HTTP with a pooled session"""
+
+    def __init__(self, api_url=BATTLE_API_URL, timeout=HTTP_TIMEOUT, pool_size=HTTP_POOL_SIZE):
+        self.api_url = api_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._misses = 0
+        self._paused_until = 0
+
+    @property
+    def available(self):
+        return time.time() >= self._paused_until
+
+    def fetch(self, battle_url):
+        """Return the battle's scoreboard or raise FastPathUnavailable"""
+        if not self.available:
+            raise FastPathUnavailable("HTTP fast path paused after repeated misses")
+        battle_id, player_id = parse_battle_url(battle_url)
+
+        try:
+            scoreboard = self._fetch_page(battle_url, battle_id, player_id)
+            if scoreboard is None and self.api_url and battle_id:
+                scoreboard = self._fetch_api(battle_id, player_id)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 429:
+                retry_after = e.response.headers.get('Retry-After', '')
+                raise FastPathRateLimited("HTTP 429 Too Many Requests",
+                                          float(retry_after) if retry_after.isdigit() else None)
+            # A 404 is about this battle; other refusals (e.g. a 403 challenge) will hit every battle
+            if e.response is None or e.response.status_code != 404:
+                self._record_miss()
+            raise FastPathUnavailable(f"HTTP fetch failed: {str(e)}")
+        except requests.RequestException as e:
+            self._record_miss()
+            raise FastPathUnavailable(f"HTTP fetch failed: {str(e)}")
+        except FastPathUnavailable:
+            raise
+        except Exception as e:
+            # Unexpected page shapes (an empty body, odd __NEXT_DATA__) are left to the browser
+            self._record_miss()
+            raise FastPathUnavailable(f"HTTP response could not be parsed: {type(e).__name__}: {str(e)}")
+
+        # A table without a known result is no better than the browser path
+        if scoreboard is None or scoreboard['is_victory'] is None or not scoreboard['teams'][0]['battle_data']:
+            self._record_miss()
+            raise FastPathUnavailable("No battle data in HTTP response")
+        with self._lock:
+            self._misses = 0
+        return scoreboard
+
+    def _fetch_page(self, battle_url, battle_id, player_id):
+        response = self.session.get(battle_url, timeout=self.timeout)
+        response.raise_for_status()
+        match = NEXT_DATA_PATTERN.search(response.text)
+        if match:
+            next_data = json.loads(match.group(1))
+            page_props = next_data.get('props', {}).get('pageProps', {})
+            try:
+                scoreboard = battle_payload_to_scoreboard(page_props, battle_id, player_id)
+            except FastPathUnavailable as e:
+                # The server-rendered tables may still tell the teams apart
+                logger.info(f"{str(e)}, reading the page's tables instead")
+                scoreboard = None
+            if scoreboard is not None:
+                return scoreboard
+        # Server-rendered pages carry the result tables themselves
+        return parse_battle_scoreboard(response.text, battle_id, player_id)
+
+    def _fetch_api(self, battle_id, player_id):
+        url = self.api_url.format(battle_id=battle_id, player_id=player_id)
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return battle_payload_to_scoreboard(response.json(), battle_id, player_id)
+
+    def _record_miss(self):
+        with self._lock:
+            self._misses += 1
+            if self._misses >= HTTP_MISS_LIMIT:
+                self._paused_until = time.time() + HTTP_RETRY_INTERVAL
+                self._misses = 0
+                logger.warning(f"HTTP fast path failed {HTTP_MISS_LIMIT} times in a row, pausing for {HTTP_RETRY_INTERVAL}s")
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def get_http_fetcher():
+    """Return the process-wide HTTP fetcher"""
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = HttpBattleFetcher()
+        return _fetcher
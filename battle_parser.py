@@ -0,0 +1,185 @@
+"""
+Offline parser for tomato.gg battle pages.
+
+Turns raw battle-page HTML (driver.page_source, an HTTP body or a saved file)
+into the same Name/Tank/Damage/.../XP records the live scraper produces,
+without needing a browser. Parsing is pure CPU work, so it can also be
+spread over a process pool.
+"""
+
+import logging
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import lxml.html
+
+from battle_record import BattleRecord
+
+logger = logging.getLogger(__name__)
+
+RESULT_XPATH = '//div[@result="win" or @result="loss"]/@result'
+# Player links in the name column look like /stats/<name>-<player_id>/<server>
+PLAYER_ID_PATTERN = re.compile(r'/stats/[^/]*-(\d+)(?:/|$)')
+
+
+def build_player_stats(cells):
+    """Build a player stats record from the text of one table row's cells"""
+    return BattleRecord(
+        name=cells[2].strip(),
+        tank=cells[1].strip(),
+        damage=cells[3],
+        frags=cells[4],
+        assist=cells[5],
+        spots=cells[6],
+        accuracy=cells[7].strip(),
+        survival=cells[8].strip(),
+        xp=cells[9]
+    )
+
+
+def build_battle_data(rows):
+    """Build player stats records from rows of cell texts, skipping incomplete rows"""
+    battle_data = []
+    logger.warning(f"Found {len(rows)} player rows in table")
+    for row_index, cells in enumerate(rows, 1):
+        try:
+            if len(cells) < 10:
+                logger.warning(f"Row {row_index} has insufficient cells: {len(cells)}")
+                continue
+
+            stats = build_player_stats(cells)
+
+            if stats.name and stats.tank:
+                battle_data.append(stats)
+            else:
+                logger.warning(f"Row {row_index} missing required data: Name={bool(stats.name)}, Tank={bool(stats.tank)}")
+
+        except Exception as e:
+            logger.warning(f"Error processing row {row_index}: {str(e)}")
+            continue
+    return battle_data
+
+
+def cell_text(cell):
+    """Approximate a cell's rendered text: one line per non-empty text node"""
+    return '\n'.join(text.strip() for text in cell.itertext() if text.strip())
+
+
+def row_player_ids(links):
+    """Extract player IDs from the stats links found in a table"""
+    player_ids = []
+    for href in links:
+        match = PLAYER_ID_PATTERN.search(href or '')
+        if match and match.group(1) not in player_ids:
+            player_ids.append(match.group(1))
+    return player_ids
+
+
+def parse_battle_teams(html):
+    """Return (result, tables) from battle-page HTML
+
+    result is the raw 'win'/'loss' attribute of the page's player, or None
+    when the page has no result element. tables holds one
+    {'rows': [[cell text, ...], ...], 'player_ids': [...]} dict per team
+    table, the page player's team first.
+    """
+    tree = lxml.html.fromstring(html)
+    result = tree.xpath(RESULT_XPATH)
+    tables = []
+    for table in tree.xpath('//table'):
+        # The first row is the header, as in the live table reads
+        rows = [[cell_text(td) for td in tr.iter('td')] for tr in table.iter('tr')][1:]
+        tables.append({'rows': rows, 'player_ids': row_player_ids(table.xpath('.//a/@href'))})
+    return (result[0] if result else None), tables
+
+
+def parse_battle_table(html):
+    """Return (result, rows) for the page player's team table, rows None without a table"""
+    result, tables = parse_battle_teams(html)
+    return result, (tables[0]['rows'] if tables else None)
+
+
+def build_scoreboard(battle_id, player_id, is_victory, tables):
+    """Build a scoreboard from team tables read from the page of player_id
+
+    A scoreboard describes a whole battle once, so every player in it can be
+    given their own view with battle_view().
+    """
+    return {
+        'battle_id': battle_id,
+        'player_id': player_id,
+        'is_victory': is_victory,
+        'teams': [
+            {'player_ids': list(table.get('player_ids') or []), 'battle_data': build_battle_data(table['rows'])}
+            for table in tables
+        ]
+    }
+
+
+def battle_view(scoreboard, player_id):
+    """Return (is_victory, battle_data) as seen by player_id, or None if they are not in the battle
+
+    Players on the second team get the other table and the opposite result.
+    """
+    if not scoreboard or not scoreboard.get('teams'):
+        return None
+    teams = scoreboard['teams']
+    is_victory = scoreboard['is_victory']
+    if player_id is None or str(player_id) == str(scoreboard.get('player_id')) or str(player_id) in teams[0]['player_ids']:
+        return is_victory, teams[0]['battle_data']
+    if len(teams) > 1 and str(player_id) in teams[1]['player_ids']:
+        return (None if is_victory is None else not is_victory), teams[1]['battle_data']
+    return None
+
+
+def parse_battle_scoreboard(html, battle_id=None, player_id=None):
+    """Parse battle-page HTML into a scoreboard, or None when the page has no results"""
+    if not html:
+        return None
+    result, tables = parse_battle_teams(html)
+    if result is None or not tables:
+        return None
+    scoreboard = build_scoreboard(battle_id, player_id, 'win' in result, tables)
+    if not scoreboard['teams'][0]['battle_data']:
+        return None
+    return scoreboard
+
+
+def parse_battle_html(html):
+    """Parse battle-page HTML into (is_victory, battle_data) for the page's player"""
+    scoreboard = parse_battle_scoreboard(html)
+    if scoreboard is None:
+        return None, []
+    return battle_view(scoreboard, None)
+
+
+def parse_battle_file(path):
+    """Parse a saved battle page from disk"""
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return parse_battle_html(f.read())
+
+
+def parse_battle_files(paths, max_workers=None):
+    """Parse many saved battle pages in a process pool, keeping input order"""
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(parse_battle_file, paths))
+
+
+def main():
+    paths = sys.argv[1:] or ['data/page_source.html']
+    start_time = time.time()
+    results = parse_battle_files(paths) if len(paths) > 1 else [parse_battle_file(paths[0])]
+    elapsed = time.time() - start_time
+
+    for path, (is_victory, battle_data) in zip(paths, results):
+        result = 'Victory' if is_victory else 'Defeat' if is_victory is not None else 'Unknown'
+        print(f"{path}: {result}, {len(battle_data)} players")
+        for stats in battle_data:
+            print("  " + " | ".join(str(value).replace('\n', ' ') for value in stats.to_dict().values()))
+    print(f"Parsed {len(paths)} pages in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
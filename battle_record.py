@@ -0,0 +1,105 @@
+"""
+Compact typed record for one player's row of a battle scoreboard.
+
+Rows are parsed once, where they are extracted (table cells, battle JSON or
+a stored scoreboard): the numeric columns become ints, the "shots/hits/pens"
+accuracy and "mm:ss" survival time are split into their numbers, and the
+repeating strings are interned. Consumers read attributes instead of
+re-parsing strings, and a __slots__ record takes a fraction of the memory of
+the dict of strings it replaces. to_dict() gives back the dict with the
+original column names for JSON, Socket.IO and Excel output.
+"""
+
+import sys
+
+COLUMNS = ['Name', 'Tank', 'Damage', 'Frags', 'Assist', 'Spots', 'Accuracy', 'Survival', 'XP']
+
+# Like sys.intern for ints: stat values repeat across rows, so equal values share one object
+_shared_ints = {}
+
+
+def _share(value):
+    return _shared_ints.setdefault(value, value)
+
+
+def parse_count(value):
+    """Parse a stat such as "1,234" by keeping only its digits; 0 when there are none"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    digits = ''.join(filter(str.isdigit, str(value if value is not None else '')))
+    try:
+        return int(digits) if digits else 0
+    except ValueError:
+        return 0
+
+
+def parse_accuracy(text):
+    """Split "shots/hits/pens" into ints; anything else counts as (0, 0, 0)"""
+    try:
+        shots, hits, pens = map(int, text.split('/'))
+        return shots, hits, pens
+    except (AttributeError, ValueError):
+        return 0, 0, 0
+
+
+def parse_survival(text):
+    """Convert "mm:ss" to seconds; anything else counts as 0"""
+    try:
+        minutes, seconds = map(int, text.split(':'))
+        return minutes * 60 + seconds
+    except (AttributeError, ValueError):
+        return 0
+
+
+class BattleRecord:
+    """One player's stats in one battle"""
+
+    __slots__ = ('name', 'tank', 'damage', 'frags', 'assist', 'spots', 'xp',
+                 'shots', 'hits', 'pens', 'survival_seconds', 'accuracy', 'survival')
+
+    def __init__(self, name, tank, damage=0, frags=0, assist=0, spots=0, accuracy='', survival='', xp=0):
+        self.name = sys.intern(name)
+        self.tank = sys.intern(tank)
+        self.damage = _share(parse_count(damage))
+        self.frags = _share(parse_count(frags))
+        self.assist = _share(parse_count(assist))
+        self.spots = _share(parse_count(spots))
+        self.xp = _share(parse_count(xp))
+        # The texts are kept for display; they repeat across rows, so interning shares them
+        self.accuracy = sys.intern(accuracy or '')
+        self.survival = sys.intern(survival or '')
+        self.shots, self.hits, self.pens = map(_share, parse_accuracy(self.accuracy))
+        self.survival_seconds = _share(parse_survival(self.survival))
+
+    @classmethod
+    def from_dict(cls, stats):
+        """Build a record from a dict keyed by COLUMNS, as stored or emitted before"""
+        return cls(stats.get('Name', ''), stats.get('Tank', ''), stats.get('Damage'), stats.get('Frags'),
+                   stats.get('Assist'), stats.get('Spots'), stats.get('Accuracy'), stats.get('Survival'),
+                   stats.get('XP'))
+
+    def to_dict(self):
+        return {
+            'Name': self.name,
+            'Tank': self.tank,
+            'Damage': str(self.damage),
+            'Frags': str(self.frags),
+            'Assist': str(self.assist),
+            'Spots': str(self.spots),
+            'Accuracy': self.accuracy,
+            'Survival': self.survival,
+            'XP': str(self.xp)
+        }
+
+    def __repr__(self):
+        return f"BattleRecord({self.name!r}, {self.tank!r}, damage={self.damage})"
+
+
+def records_to_dicts(battle_data):
+    """Convert a battle's records to dicts for JSON output"""
+    return [record.to_dict() for record in battle_data]
+
+
+def records_from_dicts(rows):
+    """Convert dicts read back from JSON to records"""
+    return [BattleRecord.from_dict(row) for row in rows]
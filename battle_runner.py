@@ -0,0 +1,196 @@
+"""
+Concurrent execution of battle analysis jobs.
+
+A job's URLs are put on a shared work queue and drained by several workers,
+each holding its own pooled Chrome driver via process_battle_chunk. Results
+are re-ordered before being reported so progress events stay in URL order.
+
+With SCRAPER_TABS above 1 each worker loads several battles at once in tabs
+of its one Chrome (tab_runner) instead of one page at a time.
+
+URLs are grouped by battle ID first: the same match submitted through several
+players' URLs is fetched once and each URL gets its own team's view of it.
+"""
+
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from battle_fetch import BASE_URL, parse_battle_url
+from battle_parser import battle_view
+from battle_scraper import SCRAPER_TABS, process_battle_chunk
+from driver_pool import DRIVER_POOL_SIZE, DriverPoolTimeout, get_driver_pool
+from retry_policy import JOB_DEADLINE, Deadline
+from tab_runner import process_battle_chunk_tabs
+
+logger = logging.getLogger(__name__)
+
+# Number of drivers a single job may use at once
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', str(DRIVER_POOL_SIZE)))
+# Extra workers only join if a driver frees up quickly; the first one waits the full lease timeout
+EXTRA_WORKER_LEASE_TIMEOUT = 5
+
+
+class OrderedResults:
+    """Buffers out-of-order results and releases them in index order"""
+
+    def __init__(self, callback=None, start=1):
+        self.callback = callback
+        self._next = start
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, index, url, is_victory, battle_data, error=None):
+        with self._lock:
+            self._pending[index] = (url, is_victory, battle_data, error)
+            # The callback runs under the lock so events can never interleave
+            while self._next in self._pending:
+                url, is_victory, battle_data, error = self._pending.pop(self._next)
+                if self.callback:
+                    try:
+                        self.callback(self._next, url, is_victory, battle_data, error)
+                    except Exception as e:
+                        logger.error(f"Result callback failed for battle {self._next}: {str(e)}")
+                self._next += 1
+
+
+class QueueDrain:
+    """Iterator over a work queue that stops whenever the queue is empty
+
+    Unlike a generator it can be iterated again later, so a worker still
+    busy with pages picks up URLs re-queued after it first ran dry.
+    """
+
+    def __init__(self, work):
+        self.work = work
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return self.work.get_nowait()
+        except queue.Empty:
+            raise StopIteration
+
+
+def canonical_battle_url(url):
+    """Normalise a battle URL to https://tomato.gg/battle/<battle_id>/<player_id>"""
+    url = url.strip()
+    battle_id, player_id = parse_battle_url(url)
+    if battle_id is None:
+        return url
+    return f"{BASE_URL}/battle/{battle_id}/{player_id}"
+
+
+def group_urls_by_battle(urls):
+    """Group 1-based (index, canonical url) pairs by battle ID, in first-seen order"""
+    groups = {}
+    for index, url in enumerate(urls, 1):
+        url = canonical_battle_url(url)
+        battle_id, _ = parse_battle_url(url)
+        groups.setdefault(battle_id or url, []).append((index, url))
+    return groups
+
+
+def run_battle_job(urls, on_result=None, max_workers=ANALYSIS_WORKERS, pool=None, deadline=JOB_DEADLINE):
+    """Process battle URLs across several pooled drivers
+
+    on_result(index, url, is_victory, battle_data, error) is called once per
+    URL, in URL order, with 1-based indexes. Battles not fetched within
+    deadline seconds are reported as errors. Returns the merged
+    (all_battles_data, victories, defeats) in URL order.
+    """
+    pool = pool or get_driver_pool()
+    job_deadline = Deadline(deadline)
+    groups = group_urls_by_battle(urls)
+
+    # Only the first URL of each battle is fetched; the others follow its result
+    work = queue.Queue()
+    followers = {}
+    for items in groups.values():
+        work.put(items[0])
+        followers[items[0][0]] = items[1:]
+    duplicates = len(urls) - len(groups)
+    if duplicates:
+        logger.warning(f"{len(urls)} URLs cover {len(groups)} battles, skipping {duplicates} duplicate page loads")
+        metrics.inc('battles_deduplicated', duplicates)
+
+    pending = QueueDrain(work)
+
+    ordered = OrderedResults(on_result)
+    fanout_lock = threading.Lock()
+    # Results are collected as they are reported rather than taken from what the workers return,
+    # so a worker that fails later does not take the battles it already reported with it
+    results_lock = threading.Lock()
+    results_data = []
+    results_counts = {'victories': 0, 'defeats': 0, 'reported': 0}
+
+    def collect(index, url, is_victory, battle_data, error=None):
+        with results_lock:
+            results_counts['reported'] += 1
+            if battle_data:
+                results_data.append((index, battle_data))
+                if is_victory is not None:
+                    results_counts['victories' if is_victory else 'defeats'] += 1
+        ordered.submit(index, url, is_victory, battle_data, error)
+
+    def handle_result(index, url, is_victory, battle_data, error=None, scoreboard=None):
+        collect(index, url, is_victory, battle_data, error)
+        with fanout_lock:
+            group_followers = followers.pop(index, [])
+            if scoreboard is None and group_followers:
+                # Nothing was read from this URL, so the next URL of the battle gets a turn
+                followers[group_followers[0][0]] = group_followers[1:]
+                work.put(group_followers[0])
+                return
+        for follower_index, follower_url in group_followers:
+            view = battle_view(scoreboard, parse_battle_url(follower_url)[1])
+            if view is None:
+                # The player is not in the tables we read, so their page has to be loaded
+                work.put((follower_index, follower_url))
+                continue
+            follower_victory, follower_data = view
+            collect(follower_index, follower_url, follower_victory, follower_data)
+
+    def worker(lease_timeout):
+        with pool.lease(lease_timeout) as lease:
+            def recycle(driver, dead=False):
+                return lease.checkpoint(dead=dead)
+            process_chunk = process_battle_chunk_tabs if SCRAPER_TABS > 1 else process_battle_chunk
+            return process_chunk(pending, driver=lease.driver, on_result=handle_result,
+                                 deadline=job_deadline, recycle=recycle)
+
+    workers = max(1, min(max_workers, len(groups)))
+    logger.warning(f"Processing {len(groups)} battles with up to {workers} drivers")
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(worker, None)]
+        futures += [executor.submit(worker, EXTRA_WORKER_LEASE_TIMEOUT) for _ in range(workers - 1)]
+        for future in futures:
+            try:
+                future.result()
+            except DriverPoolTimeout as e:
+                logger.warning(f"Worker could not lease a driver: {str(e)}")
+                errors.append(e)
+            except Exception as e:
+                logger.error(f"Worker failed: {str(e)}")
+                errors.append(e)
+
+    # URLs left behind by failed workers still get reported so the order is kept
+    leftovers = list(pending)
+    if leftovers:
+        if not results_counts['reported']:
+            raise errors[0]
+        error = errors[0] if errors else None
+        for index, url in leftovers:
+            ordered.submit(index, url, None, [], error)
+            for follower_index, follower_url in followers.pop(index, []):
+                ordered.submit(follower_index, follower_url, None, [], error)
+
+    results_data.sort(key=lambda item: item[0])
+    return [battle_data for _, battle_data in results_data], results_counts['victories'], results_counts['defeats']
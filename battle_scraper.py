@@ -2,20 +2,33 @@ from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import WebDriverException, TimeoutException
+from selenium.common.exceptions import WebDriverException
 import pandas as pd
 import time
 import logging
 import os
-from collections import defaultdict
 import concurrent.futures
-import random
+import copy
+from functools import lru_cache
 from concurrent.futures import ThreadPoolExecutor
-import queue
 from contextlib import contextmanager
 import urllib3
+import base64
+import json
+import weakref
+import metrics
+from rate_limiter import RATE_LIMIT_PER_MINUTE, get_rate_limiter
+from battle_fetch import (HTTP_FAST_PATH, FastPathRateLimited, FastPathUnavailable, battle_payload_to_scoreboard,
+                          get_http_fetcher, parse_battle_url)
+from battle_store import get_battle_store
+from chrome_cache import CHROME_CACHE_DIR, claim_cache_slot
+from player_averages import calculate_averages
+from battle_record import records_to_dicts
+from excel_export import write_averages_workbook
+from concurrency_controller import get_concurrency_controller
+from battle_parser import battle_view, build_scoreboard, parse_battle_teams, row_player_ids
+from retry_policy import (NO_DATA, NOT_FOUND, RATE_LIMITED, RETRY_MAX_ATTEMPTS, TIMEOUT, DRIVER_DEAD,
+                          DeadlineExceeded, classify_failure, get_retry_policy)
 
 # Configure urllib3 connection pooling
 urllib3.PoolManager(maxsize=10, retries=3)
@@ -30,12 +43,188 @@ selenium_logger.setLevel(logging.WARNING)
 urllib3_logger = logging.getLogger('urllib3')
 urllib3_logger.setLevel(logging.WARNING)
 
-# Global rate limiting queue - increased limit for faster processing
-request_queue = queue.Queue()
-MAX_REQUESTS_PER_MINUTE = 60
-DELAY_BETWEEN_REQUESTS = 60 / MAX_REQUESTS_PER_MINUTE
-MAX_RETRIES = 3
-RETRY_DELAY = 5
+# Requests to tomato.gg are rate limited by the shared token buckets in rate_limiter;
+# concurrency_controller moves the rate from here with the site's health
+MAX_REQUESTS_PER_MINUTE = RATE_LIMIT_PER_MINUTE
+# Attempts per URL; backoff, deadlines and the circuit breaker live in retry_policy
+MAX_RETRIES = RETRY_MAX_ATTEMPTS
+
+# How the result table is read once it has rendered:
+#   'js'       - one execute_script call returning every cell (default)
+#   'html'     - one page_source transfer parsed offline by battle_parser
+#   'elements' - one WebDriver call per row and cell (slowest, always the fallback)
+#   'network'  - the battle JSON the page fetches, read from Chrome's network log
+#                before the table renders; falls back to 'js' when none is seen
+EXTRACTION_MODE = os.getenv('EXTRACTION_MODE', 'js')
+# Seconds to watch the network log for the battle payload in 'network' mode
+NETWORK_CAPTURE_TIMEOUT = float(os.getenv('NETWORK_CAPTURE_TIMEOUT', '10'))
+NETWORK_POLL_INTERVAL = 0.1
+# Seconds after the load event with no JSON response in flight before giving up early
+NETWORK_SETTLE_TIME = 1.0
+NETWORK_CAPTURE_TYPES = ('XHR', 'Fetch')
+EXTRACT_TABLE_JS = """
+var resultElement = document.querySelector('div[result="win"], div[result="loss"]');
+var tables = [];
+var tableElements = document.querySelectorAll('table');
+for (var t = 0; t < tableElements.length; t++) {
+    var rows = [];
+    var tableRows = tableElements[t].querySelectorAll('tr');
+    for (var i = 1; i < tableRows.length; i++) {
+        var cells = [];
+        var tableCells = tableRows[i].querySelectorAll('td');
+        for (var j = 0; j < tableCells.length; j++) {
+            cells.push(tableCells[j].innerText);
+        }
+        rows.push(cells);
+    }
+    var links = [];
+    var anchors = tableElements[t].querySelectorAll('a[href*="/stats/"]');
+    for (var k = 0; k < anchors.length; k++) {
+        links.push(anchors[k].getAttribute('href'));
+    }
+    tables.push({rows: rows, links: links});
+}
+if (!tables.length) {
+    return null;
+}
+return {result: resultElement ? resultElement.getAttribute('result') : null, tables: tables};
+"""
+
+# Chrome installation and launch settings; paths are resolved once per process
+CHROME_DIR = os.getenv('CHROME_DIR', '/opt/render/project/src/chrome')
+DRIVER_LAUNCH_ATTEMPTS = 2
+CHROME_ARGUMENTS = [
+    '--headless=new',
+    '--no-sandbox',
+    '--disable-dev-shm-usage',
+    '--disable-gpu',
+    '--disable-software-rasterizer',
+    '--disable-extensions',
+    '--disable-setuid-sandbox',
+    '--window-size=1920,1080',
+    '--disable-dev-tools',
+    '--disable-logging',
+    '--log-level=3',
+    '--silent',
+    '--single-process',
+    '--disable-infobars',
+    '--disable-notifications',
+    '--disable-popup-blocking',
+    '--ignore-certificate-errors',
+    '--disable-blink-features=AutomationControlled',
+    '--disable-dbus',
+    '--no-zygote',
+    '--no-first-run',
+    '--disable-features=TranslateUI',
+    '--remote-debugging-port=0',  # Use random debugging port
+    '--disable-background-networking',
+    '--disable-default-apps',
+    '--disable-sync',
+    '--disable-translate',
+    '--hide-scrollbars',
+    '--metrics-recording-only',
+    '--mute-audio',
+    '--no-default-browser-check',
+    '--force-webrtc-ip-handling-policy=disable_non_proxied_udp',
+    '--disable-background-timer-throttling',
+    '--disable-backgrounding-occluded-windows',
+    '--disable-breakpad',
+    '--disable-component-extensions-with-background-pages',
+    '--disable-features=BackForwardCache',
+    '--disable-ipc-flooding-protection',
+    '--enable-features=NetworkService,NetworkServiceInProcess',
+]
+
+# Tabs one Chrome loads battles in concurrently; above 1 jobs use tab_runner
+SCRAPER_TABS = max(1, int(os.getenv('SCRAPER_TABS', '1')))
+
+# Seconds to wait for a loaded battle page to render its result and table
+PAGE_READY_TIMEOUT = float(os.getenv('PAGE_READY_TIMEOUT', '15'))
+# check() classifies the current page in-page so no page text has to cross
+# the wire: ready once the result div and a populated table exist, or an
+# error/rate-limit page
+BATTLE_PAGE_CHECK_JS = """
+function check() {
+    var title = document.title || '';
+    if (title.indexOf('429') !== -1 || /too many requests/i.test(title)) {
+        return {state: 'rate_limited', reason: 'title: ' + title};
+    }
+    if (title.indexOf('404') !== -1 || title.indexOf('Error') !== -1) {
+        return {state: 'error', reason: 'title: ' + title};
+    }
+    var heading = document.querySelector('h1');
+    if (heading && /404|not found/i.test(heading.textContent)) {
+        return {state: 'error', reason: 'heading: ' + heading.textContent.trim()};
+    }
+    var result = document.querySelector('div[result="win"], div[result="loss"]');
+    var table = document.querySelector('table');
+    if (result && table && table.querySelector('tr td')) {
+        return {state: 'ready', result: result.getAttribute('result')};
+    }
+    return null;
+}
+"""
+# Resolves as soon as check() does, watching DOM mutations instead of polling
+WAIT_FOR_BATTLE_JS = BATTLE_PAGE_CHECK_JS + """
+var done = arguments[arguments.length - 1];
+var timeoutMs = arguments[0];
+var state = check();
+if (state) {
+    done(state);
+    return;
+}
+var finished = false;
+var timer = null;
+var observer = new MutationObserver(function() {
+    var state = check();
+    if (state && !finished) {
+        finished = true;
+        observer.disconnect();
+        clearTimeout(timer);
+        done(state);
+    }
+});
+observer.observe(document.documentElement, {childList: true, subtree: true, attributes: true, attributeFilter: ['result']});
+timer = setTimeout(function() {
+    if (finished) {
+        return;
+    }
+    finished = true;
+    observer.disconnect();
+    done({
+        state: 'timeout',
+        result_present: !!document.querySelector('div[result="win"], div[result="loss"]'),
+        table_present: !!document.querySelector('table')
+    });
+}, timeoutMs);
+"""
+
+# Resource blocking - page load is the dominant cost per battle, and most of it is ads
+BLOCK_RESOURCES = os.getenv('BLOCK_RESOURCES', '1') != '0'
+REPORT_RESOURCE_STATS = os.getenv('REPORT_RESOURCE_STATS', '1') != '0'
+# Only these hosts resolve; every other host (ad networks, trackers, CMPs) fails DNS inside Chrome
+# The battle page loads its data client-side from tomato.gg's Supabase backend, so that host must resolve too
+TOMATO_DATA_HOST = 'rpstoohdifzdhgyxcmqa.supabase.co'
+ALLOWED_HOSTS = [host.strip() for host in os.getenv('ALLOWED_HOSTS', f'tomato.gg,*.tomato.gg,{TOMATO_DATA_HOST}').split(',')
+                 if host.strip()]
+# Requests on allowed hosts that the result table does not need
+BLOCKED_URL_PATTERNS = [
+    '*/_next/image*',
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.svg', '*.ico',
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.mp4', '*.webm',
+    '*analytics.tomato.gg*', '*tracking.tomato.gg*', '*tracking2.tomato.gg*', '*umami.tomato.gg*',
+]
+BLOCKED_ERRORS = ('net::ERR_BLOCKED_BY_CLIENT', 'net::ERR_NAME_NOT_RESOLVED')
+# Chrome's performance log feeds both the resource stats and network extraction
+PERFORMANCE_LOG = (BLOCK_RESOURCES and REPORT_RESOURCE_STATS) or EXTRACTION_MODE == 'network'
+
+# Open battles in throwaway CDP browser contexts (isolated cookies, storage and cache)
+# instead of clearing cookies in one shared tab; each context serves a few battles
+BROWSER_CONTEXTS = os.getenv('BROWSER_CONTEXTS', '1') != '0'
+BATTLES_PER_CONTEXT = max(1, int(os.getenv('BATTLES_PER_CONTEXT', '1')))
+if BROWSER_CONTEXTS and CHROME_CACHE_DIR:
+    # CDP browser contexts are off-the-record and keep their cache in memory
+    logger.warning("CHROME_CACHE_DIR is only used by pages outside browser contexts; set BROWSER_CONTEXTS=0 to use it")
 
 @contextmanager
 def create_driver():
@@ -46,291 +235,624 @@ def create_driver():
         yield driver
     except Exception as e:
         logger.error(f"Error in create_driver: {str(e)}")
-        if driver:
-            try:
-                driver.quit()
-            except:
-                pass
         raise
     finally:
         if driver:
-            try:
-                driver.quit()
-            except:
-                pass
+            quit_driver(driver)
 
-def rate_limit():
-    """Implement rate limiting for requests"""
-    try:
-        current_time = time.time()
-        request_queue.put_nowait(current_time)
-        if request_queue.qsize() > MAX_REQUESTS_PER_MINUTE:
-            oldest_request = request_queue.get()
-            time_since_oldest = current_time - oldest_request
-            if time_since_oldest < 60:
-                time.sleep(max(0.1, (60 - time_since_oldest) / MAX_REQUESTS_PER_MINUTE))
-    except queue.Full:
-        time.sleep(DELAY_BETWEEN_REQUESTS)
+def rate_limit(url=None):
+    """Wait for a token from the shared per-host rate limiter"""
+    waited = get_rate_limiter().acquire(url)
+    if waited > 0.05:
+        logger.info(f"Rate limited for {waited:.2f}s")
 
-def setup_driver():
-    """Set up Chrome driver with optimized settings"""
-    # Try different ports if the default one is in use
-    ports = list(range(9515, 9525))  # Try ports 9515-9524
-    random.shuffle(ports)  # Randomize to avoid conflicts
+@lru_cache(maxsize=None)
+def resolve_chrome_paths(chrome_dir=CHROME_DIR):
+    """Locate the Chrome binary and ChromeDriver once per process"""
+    logger.warning(f"Current working directory: {os.getcwd()}")
+    logger.warning(f"Chrome directory: {chrome_dir}")
+    possible_paths = [
+        os.path.join(chrome_dir, name) for name in
+        ['chrome', 'google-chrome', 'google-chrome-stable']
+    ]
+    chrome_binary = next((path for path in possible_paths if os.path.exists(path)), None)
+    if not chrome_binary:
+        raise FileNotFoundError("Chrome binary not found")
+    logger.warning(f"Found Chrome binary at: {chrome_binary}")
+    
+    chromedriver_path = os.path.join(chrome_dir, 'chromedriver')
+    if not os.path.exists(chromedriver_path):
+        raise FileNotFoundError("ChromeDriver not found")
     
+    # Ensure proper PATH setup
+    if chrome_dir not in os.environ.get('PATH', '').split(os.pathsep):
+        os.environ['PATH'] = f"{chrome_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+    return chrome_binary, chromedriver_path
+
+@lru_cache(maxsize=None)
+def chrome_options_template(chrome_binary):
+    """Build the Chrome options shared by every driver launch"""
     chrome_options = Options()
-    chrome_options.add_argument('--headless=new')
-    chrome_options.add_argument('--no-sandbox')
-    chrome_options.add_argument('--disable-dev-shm-usage')
-    chrome_options.add_argument('--disable-gpu')
-    chrome_options.add_argument('--disable-software-rasterizer')
-    chrome_options.add_argument('--disable-extensions')
-    chrome_options.add_argument('--disable-setuid-sandbox')
-    chrome_options.add_argument('--window-size=1920,1080')
-    chrome_options.add_argument('--disable-dev-tools')
-    chrome_options.add_argument('--disable-logging')
-    chrome_options.add_argument('--log-level=3')
-    chrome_options.add_argument('--silent')
-    chrome_options.add_argument('--single-process')
-    chrome_options.add_argument('--disable-infobars')
-    chrome_options.add_argument('--disable-notifications')
-    chrome_options.add_argument('--disable-popup-blocking')
-    chrome_options.add_argument('--ignore-certificate-errors')
-    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
-    chrome_options.add_argument('--disable-dbus')
-    chrome_options.add_argument('--no-zygote')
-    chrome_options.add_argument('--no-first-run')
-    chrome_options.add_argument('--disable-features=TranslateUI')
-    chrome_options.add_argument('--remote-debugging-port=0')  # Use random debugging port
-    chrome_options.add_argument('--disable-background-networking')
-    chrome_options.add_argument('--disable-default-apps')
-    chrome_options.add_argument('--disable-sync')
-    chrome_options.add_argument('--disable-translate')
-    chrome_options.add_argument('--hide-scrollbars')
-    chrome_options.add_argument('--metrics-recording-only')
-    chrome_options.add_argument('--mute-audio')
-    chrome_options.add_argument('--no-default-browser-check')
-    chrome_options.add_argument('--force-webrtc-ip-handling-policy=disable_non_proxied_udp')
-    chrome_options.add_argument('--disable-background-timer-throttling')
-    chrome_options.add_argument('--disable-backgrounding-occluded-windows')
-    chrome_options.add_argument('--disable-breakpad')
-    chrome_options.add_argument('--disable-component-extensions-with-background-pages')
-    chrome_options.add_argument('--disable-features=BackForwardCache')
-    chrome_options.add_argument('--disable-ipc-flooding-protection')
-    chrome_options.add_argument('--enable-features=NetworkService,NetworkServiceInProcess')
+    for argument in CHROME_ARGUMENTS:
+        chrome_options.add_argument(argument)
     chrome_options.add_experimental_option('excludeSwitches', ['enable-logging', 'enable-automation'])
     chrome_options.add_experimental_option('detach', True)
+    if BLOCK_RESOURCES:
+        chrome_options.add_argument(f'--host-resolver-rules={host_resolver_rules()}')
+    if PERFORMANCE_LOG:
+        chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+    if SCRAPER_TABS > 1:
+        # Navigations must not block, so several tabs can load at once
+        chrome_options.page_load_strategy = 'none'
+    elif EXTRACTION_MODE == 'network':
+        # The payload arrives after DOMContentLoaded; there is no need to wait for the load event
+        chrome_options.page_load_strategy = 'eager'
+    chrome_options.binary_location = chrome_binary
+    return chrome_options
+
+_cache_slots = weakref.WeakKeyDictionary()
+
+def setup_driver():
+    """Set up Chrome driver with optimized settings"""
+    chrome_binary, chromedriver_path = resolve_chrome_paths()
     
     last_exception = None
-    for port in ports:
+    for attempt in range(DRIVER_LAUNCH_ATTEMPTS):
+        driver = None
+        cache_slot = None
+        start_time = time.time()
         try:
-            # Log environment information only once at startup
-            if port == ports[0]:
-                logger.warning(f"Current working directory: {os.getcwd()}")
-                logger.warning(f"PATH: {os.environ.get('PATH', '')}")
-                logger.warning(f"Chrome directory: {os.getenv('CHROME_DIR', '/opt/render/project/src/chrome')}")
-            
-            chrome_dir = os.getenv('CHROME_DIR', '/opt/render/project/src/chrome')
-            possible_paths = [
-                os.path.join(chrome_dir, name) for name in 
-                ['chrome', 'google-chrome', 'google-chrome-stable']
-            ]
-            
-            # Log Chrome binary information only once
-            if port == ports[0]:
-                for path in possible_paths:
-                    if os.path.exists(path):
-                        logger.warning(f"Found Chrome binary at: {path}")
-                        logger.warning(f"Chrome binary permissions: {oct(os.stat(path).st_mode)[-3:]}")
-            
-            chrome_binary = next(
-                (path for path in possible_paths if os.path.exists(path)), 
-                None
-            )
-            
-            if not chrome_binary:
-                raise FileNotFoundError("Chrome binary not found")
+            chrome_options = copy.deepcopy(chrome_options_template(chrome_binary))
+            # A cache directory of its own, warm from the drivers that used it before
+            cache_slot = claim_cache_slot()
+            if cache_slot is not None:
+                for argument in cache_slot.chrome_arguments():
+                    chrome_options.add_argument(argument)
             
-            chromedriver_path = os.path.join(chrome_dir, 'chromedriver')
-            if not os.path.exists(chromedriver_path):
-                raise FileNotFoundError("ChromeDriver not found")
-            
-            # Log ChromeDriver permissions only once
-            if port == ports[0]:
-                logger.warning(f"ChromeDriver permissions: {oct(os.stat(chromedriver_path).st_mode)[-3:]}")
-            
-            # Ensure proper PATH setup
-            os.environ['PATH'] = f"{chrome_dir}:{os.environ.get('PATH', '')}"
-            chrome_options.binary_location = chrome_binary
-            
-            # Create service with specific port and log settings
+            # Port 0 lets the OS pick a free port for ChromeDriver
             service = Service(
                 executable_path=chromedriver_path,
-                port=port,
+                port=0,
                 log_output=os.devnull
             )
             
             # Create and configure driver with increased timeouts
             driver = webdriver.Chrome(service=service, options=chrome_options)
             driver.set_page_load_timeout(30)
+            driver.set_script_timeout(PAGE_READY_TIMEOUT + 5)
             driver.command_executor.set_timeout(30)
             
             # Test the connection
             driver.execute_script('return navigator.userAgent')
-            logger.warning(f"Successfully connected to ChromeDriver on port {port}")
+            if BLOCK_RESOURCES:
+                enable_resource_blocking(driver)
+            if cache_slot is not None:
+                _cache_slots[driver] = cache_slot
+                # Safety net for drivers that are dropped without quit_driver()
+                weakref.finalize(driver, cache_slot.release)
+            elapsed = time.time() - start_time
+            metrics.observe('driver_launch_seconds', elapsed)
+            logger.warning(f"Started ChromeDriver on port {service.port} in {elapsed:.2f}s")
             return driver
             
         except Exception as e:
             last_exception = e
-            if 'driver' in locals():
+            metrics.inc('driver_launch_failures')
+            logger.warning(f"Chrome driver launch attempt {attempt + 1}/{DRIVER_LAUNCH_ATTEMPTS} failed: {str(e)}")
+            if driver is not None:
                 try:
                     driver.quit()
                 except:
                     pass
+            if cache_slot is not None:
+                cache_slot.release()
             
-    raise Exception(f"Failed to create Chrome driver on any port. Last error: {str(last_exception)}")
+    raise Exception(f"Failed to create Chrome driver. Last error: {str(last_exception)}")
 
-def extract_battle_data_with_retry(driver, battle_url, max_retries=MAX_RETRIES):
-    """Extract battle data with retry logic"""
-    for attempt in range(max_retries):
+def quit_driver(driver):
+    """Quit a driver and free its cache directory for the next one"""
+    try:
+        driver.quit()
+    except Exception:
+        pass
+    cache_slot = _cache_slots.pop(driver, None)
+    if cache_slot is not None:
+        cache_slot.release()
+    # The session references its driver, so the weak key alone would never let the entry go
+    _browser_contexts.pop(driver, None)
+
+def host_resolver_rules():
+    """Chrome host resolver rules that only let ALLOWED_HOSTS resolve"""
+    rules = ['MAP * ~NOTFOUND']
+    rules += [f'EXCLUDE {host}' for host in ALLOWED_HOSTS + ['localhost']]
+    return ', '.join(rules)
+
+def enable_resource_blocking(driver):
+    """Block images, fonts and first-party trackers in the driver's current target"""
+    try:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_URL_PATTERNS})
+    except Exception as e:
+        logger.warning(f"Failed to enable resource blocking: {str(e)}")
+
+def drain_performance_log(driver):
+    """Return and clear the (method, params) DevTools events buffered by Chrome"""
+    messages = []
+    try:
+        entries = driver.get_log('performance')
+    except Exception:
+        return messages
+    for entry in entries:
         try:
-            rate_limit()
-            
-            # Log attempt information
-            logger.warning(f"Processing battle {battle_url} (Attempt {attempt + 1}/{max_retries})")
-            
-            # Clear any existing state
-            try:
-                driver.delete_all_cookies()
-            except Exception as e:
-                logger.warning(f"Failed to clear cookies: {str(e)}")
-            
-            # Test driver health before proceeding
+            message = json.loads(entry['message'])['message']
+        except (KeyError, ValueError):
+            continue
+        messages.append((message.get('method'), message.get('params', {})))
+    return messages
+
+def summarize_resource_log(messages):
+    """Count requests made, blocked and served from disk cache, and bytes transferred for one page"""
+    requests_sent = 0
+    requests_blocked = 0
+    requests_finished = 0
+    responses = 0
+    from_disk_cache = 0
+    bytes_loaded = 0
+    for method, params in messages:
+        if method == 'Network.requestWillBeSent':
+            requests_sent += 1
+        elif method == 'Network.responseReceived':
+            responses += 1
+            if params.get('response', {}).get('fromDiskCache'):
+                from_disk_cache += 1
+        elif method == 'Network.loadingFinished':
+            requests_finished += 1
+            bytes_loaded += params.get('encodedDataLength', 0)
+        elif method == 'Network.loadingFailed':
+            if params.get('blockedReason') or params.get('errorText') in BLOCKED_ERRORS:
+                requests_blocked += 1
+    # Blocked responses never arrive, so their size is estimated from the ones that did
+    average_bytes = bytes_loaded / requests_finished if requests_finished else 0
+    return {
+        'requests': requests_sent,
+        'requests_blocked': requests_blocked,
+        'responses': responses,
+        'from_disk_cache': from_disk_cache,
+        'bytes_loaded': int(bytes_loaded),
+        'bytes_saved_estimate': int(requests_blocked * average_bytes)
+    }
+
+def record_page_resources(driver, battle_url, messages=None):
+    """Log and count what resource blocking saved on the page just loaded
+
+    messages are events already drained from the performance log for this page.
+    """
+    if not (BLOCK_RESOURCES and REPORT_RESOURCE_STATS):
+        return None
+    page_stats = summarize_resource_log(list(messages or []) + drain_performance_log(driver))
+    metrics.inc('pages_loaded')
+    metrics.inc('page_requests', page_stats['requests'])
+    metrics.inc('page_requests_blocked', page_stats['requests_blocked'])
+    metrics.inc('page_bytes_loaded', page_stats['bytes_loaded'])
+    metrics.inc('page_bytes_saved_estimate', page_stats['bytes_saved_estimate'])
+    metrics.inc('page_responses', page_stats['responses'])
+    metrics.inc('page_responses_from_disk_cache', page_stats['from_disk_cache'])
+    responses = metrics.get_counter('page_responses')
+    if responses:
+        metrics.set_gauge('disk_cache_hit_ratio', round(metrics.get_counter('page_responses_from_disk_cache') / responses, 3))
+    logger.warning(f"Resources for {battle_url}: {page_stats['requests']} requests, "
+                   f"{page_stats['requests_blocked']} blocked, {page_stats['from_disk_cache']} from disk cache, "
+                   f"{page_stats['bytes_loaded']:,} bytes loaded, ~{page_stats['bytes_saved_estimate']:,} bytes saved")
+    return page_stats
+
+class BrowserContextSession:
+    """A disposable CDP browser context with one tab, used for a few battles on one driver"""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.home_handle = driver.current_window_handle
+        self.context_id = driver.execute_cdp_cmd('Target.createBrowserContext', {})['browserContextId']
+        try:
+            target = driver.execute_cdp_cmd('Target.createTarget', {
+                'url': 'about:blank',
+                'browserContextId': self.context_id
+            })
+            # chromedriver window handles are DevTools target IDs
+            self.handle = target['targetId']
+            driver.switch_to.window(self.handle)
+        except Exception:
+            self._dispose()
+            raise
+        self.pages = 0
+        # Network settings are per target, so the new tab needs its own blocking rules
+        if BLOCK_RESOURCES:
+            enable_resource_blocking(driver)
+        metrics.inc('browser_contexts_created')
+
+    def close(self):
+        """Dispose of the context (closing its tab) and switch back to the driver's own tab"""
+        self._dispose()
+        try:
+            self.driver.switch_to.window(self.home_handle)
+        except Exception as e:
+            logger.warning(f"Failed to switch back to the driver's tab: {str(e)}")
+
+    def _dispose(self):
+        try:
+            self.driver.execute_cdp_cmd('Target.disposeBrowserContext', {'browserContextId': self.context_id})
+        except Exception as e:
+            logger.warning(f"Failed to dispose browser context: {str(e)}")
+
+
+_browser_contexts = weakref.WeakKeyDictionary()
+
+def prepare_page_state(driver):
+    """Give the next battle a clean browser state
+
+    Uses a fresh browser context every BATTLES_PER_CONTEXT battles, falling
+    back to clearing cookies in the driver's own tab when contexts are off or
+    unavailable.
+    """
+    if BROWSER_CONTEXTS:
+        session = _browser_contexts.get(driver)
+        if session is not None and session.pages >= BATTLES_PER_CONTEXT:
+            close_browser_context(driver)
+            session = None
+        if session is None:
             try:
-                driver.current_url
+                session = BrowserContextSession(driver)
+                _browser_contexts[driver] = session
             except Exception as e:
-                logger.warning(f"Driver health check failed: {str(e)}")
-                raise WebDriverException("Driver is not responsive")
-            
-            # Load the page with retry on timeout
-            load_attempts = 3
-            for load_attempt in range(load_attempts):
-                try:
-                    logger.warning(f"Loading page (Attempt {load_attempt + 1}/{load_attempts})")
-                    driver.get(battle_url)
-                    # Quick check for obvious errors
-                    if "404" in driver.title or "Error" in driver.title:
-                        logger.warning(f"Error page detected in title: {driver.title}")
-                        return None, []
-                    break
-                except TimeoutException:
-                    if load_attempt < load_attempts - 1:
-                        logger.warning(f"Page load timeout, attempt {load_attempt + 1}/{load_attempts}")
-                        continue
-                    raise
-                except Exception as e:
-                    logger.warning(f"Unexpected error during page load: {str(e)}")
-                    raise
-            
-            # Wait for result element with a more robust check
-            wait = WebDriverWait(driver, 15)  # Reduced timeout
-            result_xpath = "//div[@result='win'] | //div[@result='loss']"
-            
-            # First check if page loaded at all
-            try:
-                body = wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
-                if "404" in body.text or "error" in body.text.lower():
-                    logger.warning("Error content detected in body text")
-                    return None, []
-            except TimeoutException:
-                logger.warning("Timeout waiting for page body")
-                raise
-            
-            # Then check for specific elements
-            try:
-                result_element = wait.until(EC.presence_of_element_located((By.XPATH, result_xpath)))
-                logger.warning("Battle result element found")
-            except TimeoutException:
-                logger.warning("Timeout waiting for battle result element")
-                return None, []
-            
-            is_victory = 'win' in result_element.get_attribute('result')
-            logger.warning(f"Battle result: {'Victory' if is_victory else 'Defeat'}")
-            
-            # Wait for table with explicit presence check
-            try:
-                table = wait.until(EC.presence_of_element_located((By.TAG_NAME, "table")))
-                if not table.is_displayed():
-                    wait.until(EC.visibility_of(table))
-                logger.warning("Battle data table found and visible")
-            except TimeoutException:
-                logger.warning("Timeout waiting for battle data table")
-                return None, []
-            
-            rows = table.find_elements(By.TAG_NAME, "tr")[1:]
-            logger.warning(f"Found {len(rows)} player rows in table")
-            
-            battle_data = []
-            for row_index, row in enumerate(rows, 1):
-                try:
-                    cells = row.find_elements(By.TAG_NAME, "td")
-                    if len(cells) < 10:
-                        logger.warning(f"Row {row_index} has insufficient cells: {len(cells)}")
-                        continue
-                    
-                    stats = {
-                        'Name': cells[2].text.strip(),
-                        'Tank': cells[1].text.strip(),
-                        'Damage': ''.join(filter(str.isdigit, cells[3].text.strip())) or '0',
-                        'Frags': ''.join(filter(str.isdigit, cells[4].text.strip())) or '0',
-                        'Assist': ''.join(filter(str.isdigit, cells[5].text.strip())) or '0',
-                        'Spots': ''.join(filter(str.isdigit, cells[6].text.strip())) or '0',
-                        'Accuracy': cells[7].text.strip(),
-                        'Survival': cells[8].text.strip(),
-                        'XP': ''.join(filter(str.isdigit, cells[9].text.strip())) or '0'
-                    }
-                    
-                    if stats['Name'] and stats['Tank']:
-                        battle_data.append(stats)
-                    else:
-                        logger.warning(f"Row {row_index} missing required data: Name={bool(stats['Name'])}, Tank={bool(stats['Tank'])}")
-                    
-                except Exception as e:
-                    logger.warning(f"Error processing row {row_index}: {str(e)}")
+                logger.warning(f"Failed to create browser context, clearing cookies instead: {str(e)}")
+        if session is not None:
+            session.pages += 1
+            return
+
+    try:
+        driver.delete_all_cookies()
+    except Exception as e:
+        logger.warning(f"Failed to clear cookies: {str(e)}")
+
+    # Test driver health before proceeding
+    try:
+        driver.current_url
+    except Exception as e:
+        logger.warning(f"Driver health check failed: {str(e)}")
+        raise WebDriverException("Driver is not responsive")
+
+def close_browser_context(driver):
+    """Dispose of the driver's current battle context, if any"""
+    session = _browser_contexts.pop(driver, None)
+    if session is not None:
+        session.close()
+
+def wait_for_battle_page(driver, timeout=PAGE_READY_TIMEOUT):
+    """Wait in-page for the battle result and table to render
+
+    Returns {'state': 'ready', 'result': 'win'|'loss'}, {'state': 'error' or
+    'rate_limited', 'reason': ...} for error pages, or {'state': 'timeout', ...}
+    saying what was missing.
+    """
+    state = driver.execute_async_script(WAIT_FOR_BATTLE_JS, int(timeout * 1000))
+    return state or {'state': 'timeout', 'result_present': False, 'table_present': False}
+
+def read_response_json(driver, request_id):
+    """Return the parsed JSON body of a finished network request, or None"""
+    try:
+        response = driver.execute_cdp_cmd('Network.getResponseBody', {'requestId': request_id})
+        body = response.get('body', '')
+        if response.get('base64Encoded'):
+            body = base64.b64decode(body).decode('utf-8', errors='replace')
+        return json.loads(body)
+    except Exception as e:
+        logger.info(f"Could not read response body {request_id}: {str(e)}")
+        return None
+
+def capture_battle_payload(driver, battle_id, player_id, timeout=NETWORK_CAPTURE_TIMEOUT):
+    """Watch the page's XHR/fetch responses for the battle JSON and map it to a scoreboard
+
+    Returns (scoreboard or None, messages), messages being every performance
+    log event read so the resource stats can still be computed.
+    """
+    messages = []
+    candidates = {}  # requestId -> url of JSON responses not finished yet
+    deadline = time.time() + timeout
+    loaded_at = None
+    while True:
+        batch = drain_performance_log(driver)
+        messages.extend(batch)
+        for method, params in batch:
+            if method == 'Page.loadEventFired':
+                loaded_at = time.time()
+            elif method == 'Network.responseReceived':
+                response = params.get('response', {})
+                if params.get('type') in NETWORK_CAPTURE_TYPES and 'json' in response.get('mimeType', ''):
+                    candidates[params.get('requestId')] = response.get('url')
+            elif method == 'Network.loadingFinished' and params.get('requestId') in candidates:
+                url = candidates.pop(params['requestId'])
+                payload = read_response_json(driver, params['requestId'])
+                if payload is None:
                     continue
-            
-            if battle_data:  # Only return if we got data
-                logger.warning(f"Successfully extracted data for {len(battle_data)} players")
-                return is_victory, battle_data
-            else:
-                logger.warning("No valid battle data found in table")
-                return None, []
-            
-        except (WebDriverException, TimeoutException) as e:
-            if attempt < max_retries - 1:
-                logger.warning(f"Attempt {attempt + 1} failed for {battle_url}: {str(e)}")
-                time.sleep(RETRY_DELAY)  # Wait before retrying
                 try:
-                    # Try to recover the driver
-                    driver.execute_script('return navigator.userAgent')
-                    logger.warning("Driver recovery successful")
-                except Exception as recovery_e:
-                    logger.warning(f"Driver recovery failed: {str(recovery_e)}")
-                    # If driver is dead, create a new one
-                    try:
-                        driver.quit()
-                    except:
-                        pass
-                    logger.warning("Creating new driver instance")
-                    driver = setup_driver()
-            else:
-                logger.error(f"All attempts failed for {battle_url}: {str(e)}")
-                return None, []
+                    scoreboard = battle_payload_to_scoreboard(payload, battle_id, player_id)
+                except FastPathUnavailable:
+                    # Without the teams the rendered table is the better source
+                    continue
+                if scoreboard and scoreboard['is_victory'] is not None and scoreboard['teams'][0]['battle_data']:
+                    logger.warning(f"Captured battle payload from {url}")
+                    metrics.inc('network_payloads_captured')
+                    return scoreboard, messages
+        now = time.time()
+        # A page rendered from inline data has no payload to wait for
+        settled = loaded_at is not None and not candidates and now - loaded_at >= NETWORK_SETTLE_TIME
+        if now >= deadline or settled:
+            metrics.inc('network_payloads_missed')
+            return None, messages
+        time.sleep(NETWORK_POLL_INTERVAL)
+
+def extract_table_js(driver):
+    """Read the battle result and every team table with a single execute_script call"""
+    table_data = driver.execute_script(EXTRACT_TABLE_JS)
+    if not table_data or not table_data.get('tables'):
+        raise WebDriverException("Battle table not present for JavaScript extraction")
+    for table in table_data['tables']:
+        table['player_ids'] = row_player_ids(table.pop('links', []))
+    return table_data
+
+def extract_table_html(driver):
+    """Read the battle result and team tables by parsing the page source offline"""
+    result, tables = parse_battle_teams(driver.page_source)
+    if not tables:
+        raise WebDriverException("Battle table not present in page source")
+    return {'result': result, 'tables': tables}
+
+def extract_table_elements(table):
+    """Read the first table's cells element by element (slow path, one round trip per cell)"""
+    rows = []
+    for row in table.find_elements(By.TAG_NAME, "tr")[1:]:
+        try:
+            rows.append([cell.text for cell in row.find_elements(By.TAG_NAME, "td")])
         except Exception as e:
-            logger.error(f"Unexpected error processing {battle_url}: {str(e)}")
-            return None, []
+            logger.warning(f"Error reading table row: {str(e)}")
+            rows.append([])
+    return [{'rows': rows, 'player_ids': []}]
+
+def extract_battle_data_with_retry(driver, battle_url, max_retries=MAX_RETRIES, deadline=None):
+    """Extract battle data as seen by the URL's player"""
+    scoreboard = extract_battle_scoreboard(driver, battle_url, max_retries, deadline)
+    _, player_id = parse_battle_url(battle_url)
+    view = battle_view(scoreboard, player_id) if scoreboard else None
+    if view is None:
+        return None, []
+    return view
+
+def extract_battle_scoreboard(driver, battle_url, max_retries=MAX_RETRIES, deadline=None):
+    """Extract a battle's scoreboard, serving already scraped or recently failed battles from the battle store"""
+    found, scoreboard = stored_scoreboard(battle_url)
+    if found:
+        return scoreboard
     
-    return None, []
+    scoreboard = fetch_battle_data(driver, battle_url, max_retries, deadline)
+    save_scoreboard(battle_url, scoreboard)
+    return scoreboard
+
+def stored_scoreboard(battle_url):
+    """Look a battle up in the battle store
+
+    Returns (True, scoreboard) for a stored battle, (True, None) for one that
+    recently failed, and (False, None) when it has to be fetched.
+    """
+    store = get_battle_store()
+    if store is None:
+        return False, None
+    try:
+        cached = store.get_scoreboard(battle_url)
+        failure = store.get_failure(battle_url) if cached is None else None
+    except Exception as e:
+        logger.warning(f"Battle store lookup failed: {str(e)}")
+        return False, None
+    if cached is not None:
+        logger.warning(f"Battle store hit for {battle_url}")
+        return True, cached
+    if failure is not None:
+        logger.warning(f"Skipping {battle_url}, it recently failed ({failure})")
+        return True, None
+    return False, None
+
+def save_scoreboard(battle_url, scoreboard):
+    """Keep a freshly fetched scoreboard in the battle store"""
+    store = get_battle_store()
+    if store is not None and scoreboard:
+        try:
+            store.put_scoreboard(scoreboard)
+        except Exception as e:
+            logger.warning(f"Failed to store battle {battle_url}: {str(e)}")
+
+class DriverDead(WebDriverException):
+    """Raised when the driver stopped responding and has to be replaced by its owner"""
+
+def driver_is_alive(driver):
+    try:
+        driver.execute_script('return navigator.userAgent')
+        return True
+    except Exception:
+        return False
+
+class PageLoadFailed(Exception):
+    """A battle page loaded but could not be read; failure is a retry_policy failure class"""
+
+    def __init__(self, failure, message):
+        super().__init__(message)
+        self.failure = failure
+
+def remember_failure(battle_url, reason):
+    """Record a definitive failure in the battle store's negative cache"""
+    store = get_battle_store()
+    if store is None:
+        return
+    try:
+        store.put_failure(battle_url, reason)
+    except Exception as e:
+        logger.warning(f"Failed to record failure for {battle_url}: {str(e)}")
+
+def fetch_battle_data(driver, battle_url, max_retries=MAX_RETRIES, deadline=None):
+    """Fetch a battle's scoreboard with retry logic, trying the browserless HTTP path first
+
+    deadline is the job's retry_policy.Deadline. Returns None when the battle
+    could not be read, and raises DeadlineExceeded or CircuitOpen when it was
+    not attempted.
+    """
+    if deadline is not None and deadline.expired:
+        raise DeadlineExceeded("Job deadline passed before the battle was fetched")
+    policy = get_retry_policy()
+    url_deadline = policy.url_deadline(deadline)
+    battle_id, player_id = parse_battle_url(battle_url)
+    
+    scoreboard = fetch_over_http(battle_url, policy, url_deadline)
+    if scoreboard is not None:
+        return scoreboard
+    
+    max_attempts = min(max_retries, policy.max_attempts) if max_retries else policy.max_attempts
+    controller = get_concurrency_controller()
+    attempt = 0
+    while True:
+        attempt += 1
+        policy.breaker.wait(url_deadline)
+        try:
+            controller.acquire(url_deadline)
+        except DeadlineExceeded:
+            policy.breaker.release_probe()
+            raise
+        try:
+            rate_limit(battle_url)
+            logger.warning(f"Processing battle {battle_url} (Attempt {attempt}/{max_attempts})")
+            started = time.time()
+            scoreboard = load_battle_page(driver, battle_url, battle_id, player_id)
+            policy.record()
+            controller.record(time.time() - started)
+            return scoreboard
+        except PageLoadFailed as e:
+            failure, error = e.failure, e
+        except Exception as e:
+            failure, error = classify_failure(e), e
+        finally:
+            controller.release()
+        
+        policy.record(failure)
+        controller.record(failure=failure)
+        # A context that failed a page is not reused for the retry
+        close_browser_context(driver)
+        delay = policy.next_delay(attempt, failure, url_deadline) if attempt < max_attempts else None
+        if delay is None:
+            if failure in (NOT_FOUND, NO_DATA):
+                logger.warning(f"Giving up on {battle_url} ({failure}): {str(error)}")
+                # An empty table may just have rendered late, so only error pages are remembered
+                if failure == NOT_FOUND:
+                    remember_failure(battle_url, failure)
+            else:
+                logger.error(f"Giving up on {battle_url} after {attempt} attempt(s) ({failure}): {str(error)}")
+            return None
+        logger.warning(f"Attempt {attempt} failed for {battle_url} ({failure}), retrying in {delay:.1f}s: {str(error)}")
+        time.sleep(delay)
+        
+        if failure == DRIVER_DEAD and not driver_is_alive(driver):
+            # Replacing the driver is up to whoever owns it (the pool or process_battle_chunk)
+            raise DriverDead(f"Driver died while processing {battle_url}: {str(error)}")
+
+def fetch_over_http(battle_url, policy, url_deadline):
+    """Try the browserless HTTP fast path; return the scoreboard or None to use the browser"""
+    if not HTTP_FAST_PATH:
+        return None
+    http_fetcher = get_http_fetcher()
+    if not http_fetcher.available:
+        return None
+    try:
+        policy.breaker.wait(url_deadline)
+        rate_limit(battle_url)
+        scoreboard = http_fetcher.fetch(battle_url)
+        policy.record()
+        logger.warning(f"Fetched {battle_url} over HTTP ({len(scoreboard['teams'][0]['battle_data'])} players)")
+        return scoreboard
+    except FastPathRateLimited as e:
+        # The browser would get the same answer, so back off before trying it
+        policy.record(RATE_LIMITED)
+        get_concurrency_controller().record(failure=RATE_LIMITED)
+        delay = min(policy.backoff(1, RATE_LIMITED, e.retry_after), url_deadline.remaining())
+        logger.warning(f"Rate limited by tomato.gg, backing off {delay:.1f}s")
+        time.sleep(delay)
+    except FastPathUnavailable as e:
+        logger.info(f"HTTP fast path unavailable for {battle_url}, using Selenium: {str(e)}")
+    finally:
+        # An outcome recorded above settled the probe; a fetch that never reached the site hands it on
+        policy.breaker.release_probe()
+    return None
+
+# Battle pages each driver has navigated to; store hits and HTTP results don't count
+_browser_pages = weakref.WeakKeyDictionary()
+
+def browser_pages(driver):
+    return _browser_pages.get(driver, 0)
+
+def load_battle_page(driver, battle_url, battle_id, player_id):
+    """Load one battle page and read its scoreboard, raising PageLoadFailed when it cannot be read"""
+    _browser_pages[driver] = browser_pages(driver) + 1
+    # Start from clean cookies and storage
+    prepare_page_state(driver)
+    
+    # Drop events left over from an earlier page so the stats cover this one
+    if PERFORMANCE_LOG:
+        drain_performance_log(driver)
+    
+    # Page load timeouts are retried by the caller's policy
+    driver.get(battle_url)
+    
+    # Take the battle JSON off the wire when the page fetches it, skipping the render
+    network_messages = []
+    if EXTRACTION_MODE == 'network':
+        scoreboard, network_messages = capture_battle_payload(driver, battle_id, player_id)
+        if scoreboard is not None:
+            logger.warning(f"Successfully extracted data for {len(scoreboard['teams'][0]['battle_data'])} players")
+            record_page_resources(driver, battle_url, network_messages)
+            return scoreboard
+        logger.warning("No battle payload seen on the network, reading the rendered table")
+    
+    # Wait for the result and table in one in-page call
+    page_state = wait_for_battle_page(driver)
+    if page_state['state'] == 'error':
+        raise PageLoadFailed(NOT_FOUND, f"Error page detected: {page_state.get('reason')}")
+    if page_state['state'] == 'rate_limited':
+        raise PageLoadFailed(RATE_LIMITED, f"Rate limited page: {page_state.get('reason')}")
+    if page_state['state'] != 'ready':
+        missing = 'battle result element' if not page_state.get('result_present') else 'battle data table'
+        raise PageLoadFailed(TIMEOUT, f"Timeout waiting for {missing}")
+    logger.warning("Battle result and data table found")
+    
+    # Pull the whole table in one round trip, falling back to per-element reads
+    table_data = None
+    if EXTRACTION_MODE in ('js', 'html', 'network'):
+        try:
+            table_data = extract_table_html(driver) if EXTRACTION_MODE == 'html' else extract_table_js(driver)
+        except WebDriverException as e:
+            logger.warning(f"{EXTRACTION_MODE} table extraction failed, using element reads: {str(e)}")
+    
+    if table_data and table_data.get('result'):
+        is_victory = 'win' in table_data['result']
+    else:
+        is_victory = 'win' in page_state['result']
+    logger.warning(f"Battle result: {'Victory' if is_victory else 'Defeat'}")
+    
+    if table_data is not None:
+        tables = table_data['tables']
+    else:
+        tables = extract_table_elements(driver.find_element(By.TAG_NAME, "table"))
+    scoreboard = build_scoreboard(battle_id, player_id, is_victory, tables)
+    battle_data = scoreboard['teams'][0]['battle_data']
+    
+    if not battle_data:
+        raise PageLoadFailed(NO_DATA, "No valid battle data found in table")
+    logger.warning(f"Successfully extracted data for {len(battle_data)} players")
+    record_page_resources(driver, battle_url, network_messages)
+    return scoreboard
 
 def save_to_excel(data, filename):
     if not data:
@@ -339,7 +861,7 @@ def save_to_excel(data, filename):
     
     try:
         # Convert data to DataFrame
-        df = pd.DataFrame(data)
+        df = pd.DataFrame(records_to_dicts(data))
         logger.info(f"Created DataFrame with {len(df)} rows")
         
         # Ensure columns are in the right order
@@ -462,89 +984,6 @@ def save_to_excel(data, filename):
         for row in data:
             print(row)
 
-def calculate_averages(all_battles_data):
-    """Calculate average stats for each player across all battles."""
-    # Initialize dictionaries to store sums and counts
-    player_stats = defaultdict(lambda: {
-        'battles': 0,
-        'total_damage': 0,
-        'total_frags': 0,
-        'total_assist': 0,
-        'total_spots': 0,
-        'total_xp': 0,
-        'tanks': set(),  # Track unique tanks played
-        'accuracy_hits': 0,
-        'accuracy_shots': 0,
-        'accuracy_pens': 0,
-        'survival_time': 0  # in seconds
-    })
-    
-    # Process each battle's data
-    for battle_data in all_battles_data:
-        for player in battle_data:
-            name = player['Name']
-            player_stats[name]['battles'] += 1
-            
-            player_stats[name]['total_damage'] += int(player['Damage'])
-            player_stats[name]['total_frags'] += int(player['Frags'])
-            player_stats[name]['total_assist'] += int(player['Assist'])
-            player_stats[name]['total_spots'] += int(player['Spots'])
-            player_stats[name]['total_xp'] += int(player['XP'])
-            player_stats[name]['tanks'].add(player['Tank'])
-            
-            # Process accuracy (format: "shots/hits/pens")
-            try:
-                shots, hits, pens = map(int, player['Accuracy'].split('/'))
-                player_stats[name]['accuracy_shots'] += shots
-                player_stats[name]['accuracy_hits'] += hits
-                player_stats[name]['accuracy_pens'] += pens
-            except:
-                pass
-            
-            # Process survival time (format: "mm:ss")
-            try:
-                minutes, seconds = map(int, player['Survival'].split(':'))
-                player_stats[name]['survival_time'] += minutes * 60 + seconds
-            except:
-                pass
-    
-    # Calculate averages
-    averages_data = []
-    for name, stats in player_stats.items():
-        battles = stats['battles']
-        if battles > 0:
-            avg_stats = {
-                'Name': name,
-                'Battles': battles,
-                'Avg Damage': round(stats['total_damage'] / battles, 1),
-                'Avg Frags': round(stats['total_frags'] / battles, 2),
-                'Avg Assist': round(stats['total_assist'] / battles, 1),
-                'Avg Spots': round(stats['total_spots'] / battles, 2),
-                'Avg XP': round(stats['total_xp'] / battles, 1),
-                'Tanks Used': len(stats['tanks']),
-                'Tank List': ', '.join(sorted(stats['tanks'])),
-            }
-            
-            # Calculate accuracy percentages with proper averaging
-            if stats['accuracy_shots'] > 0:
-                # Calculate hit rate (hits / shots)
-                hit_rate = (stats['accuracy_hits'] / stats['accuracy_shots']) * 100
-                # Calculate pen rate (pens / hits)
-                pen_rate = (stats['accuracy_pens'] / stats['accuracy_hits']) * 100 if stats['accuracy_hits'] > 0 else 0
-                avg_stats['Hit Rate'] = f"{hit_rate:.1f}%"
-                avg_stats['Pen Rate'] = f"{pen_rate:.1f}%"
-            else:
-                avg_stats['Hit Rate'] = "N/A"
-                avg_stats['Pen Rate'] = "N/A"
-            
-            # Calculate average survival time
-            avg_survival_seconds = stats['survival_time'] / battles
-            avg_stats['Avg Survival'] = f"{int(avg_survival_seconds // 60)}:{int(avg_survival_seconds % 60):02d}"
-            
-            averages_data.append(avg_stats)
-    
-    return averages_data
-
 def save_averages_to_excel(averages_data, output_file, battle_summary=None):
     """Save averages data to Excel file with optional battle summary."""
     if not averages_data:
@@ -552,151 +991,92 @@ def save_averages_to_excel(averages_data, output_file, battle_summary=None):
         return
 
     try:
-        # Create DataFrame and sort by Avg Damage in descending order
-        df = pd.DataFrame(averages_data)
-        df = df.sort_values(by='Avg Damage', ascending=False)
-        
-        # Modify Tank List to be more compact
-        df['Tank List'] = df['Tank List'].apply(lambda x: x.replace(', ', ','))
-        
-        # Create Excel writer object with xlsxwriter engine
-        writer = pd.ExcelWriter(output_file, engine='xlsxwriter')
-        
-        # Write averages data
-        df.to_excel(writer, sheet_name='Player Averages', index=False)
-        
-        # Get the workbook and worksheet objects
-        workbook = writer.book
-        worksheet = writer.sheets['Player Averages']
-        
-        # Add formats
-        header_format = workbook.add_format({
-            'bold': True,
-            'bg_color': '#4B5320',
-            'font_color': 'white',
-            'border': 1,
-            'align': 'center',
-            'text_wrap': True,
-            'valign': 'vcenter'
-        })
-        
-        cell_format = workbook.add_format({
-            'border': 1,
-            'align': 'left',
-            'valign': 'vcenter',
-            'text_wrap': False  # Disable text wrapping for tank list
-        })
-        
-        number_format = workbook.add_format({
-            'border': 1,
-            'align': 'center',
-            'valign': 'vcenter',
-            'num_format': '#,##0.0'
-        })
-        
-        # Set column widths
-        column_widths = {
-            'Name': 30,
-            'Battles': 10,
-            'Avg Damage': 12,
-            'Avg Frags': 10,
-            'Avg Assist': 12,
-            'Avg Spots': 10,
-            'Avg XP': 10,
-            'Tanks Used': 12,
-            'Tank List': 35,  # Fixed width for tank list
-            'Hit Rate': 10,
-            'Pen Rate': 10,
-            'Avg Survival': 12
-        }
-        
-        # Set fixed column widths
-        for col_num, column in enumerate(df.columns):
-            width = column_widths.get(column, 15)
-            worksheet.set_column(col_num, col_num, width)
-        
-        # Format headers
-        for col_num, column in enumerate(df.columns):
-            worksheet.write(0, col_num, column, header_format)
-        
-        # Write data with formatting
-        for row in range(len(df)):
-            for col, column in enumerate(df.columns):
-                value = df.iloc[row][column]
-                if column == 'Tank List':
-                    # Add a comment with the full tank list
-                    full_list = str(value).replace(',', '\n')
-                    worksheet.write_comment(row + 1, col, full_list, {'width': 200, 'height': 100})
-                    # Write the truncated value
-                    if len(str(value)) > 50:
-                        truncated = str(value)[:47] + "..."
-                        worksheet.write(row + 1, col, truncated, cell_format)
-                    else:
-                        worksheet.write(row + 1, col, value, cell_format)
-                elif isinstance(value, (int, float)) and column not in ['Battles', 'Tanks Used']:
-                    worksheet.write_number(row + 1, col, value, number_format)
-                else:
-                    worksheet.write(row + 1, col, value, cell_format)
-        
-        # Set row height
-        worksheet.set_default_row(20)
-        
-        # Add alternating row colors
-        for row in range(1, len(df) + 1, 2):
-            worksheet.set_row(row, None, workbook.add_format({
-                'bg_color': '#F0F0F0',
-                'border': 1,
-                'text_wrap': False,
-                'valign': 'vcenter'
-            }))
-        
-        # Add battle summary below the main table if provided
-        if battle_summary:
-            summary_start_row = len(df) + 3
-            summary_format = workbook.add_format({
-                'bold': True,
-                'align': 'left',
-                'valign': 'vcenter',
-                'font_size': 11
-            })
-            
-            summary_text = (
-                f"Battle Summary - "
-                f"Total Battles: {battle_summary['total_battles']}  |  "
-                f"Victories: {battle_summary['victories']}  |  "
-                f"Defeats: {battle_summary['defeats']}  |  "
-                f"Win Rate: {battle_summary['win_rate']:.1f}%"
-            )
-            
-            worksheet.merge_range(
-                summary_start_row, 0, 
-                summary_start_row, len(df.columns) - 1, 
-                summary_text, summary_format
-            )
-        
-        writer.close()
+        write_averages_workbook(averages_data, output_file, battle_summary)
         logger.info(f"Excel file saved successfully to: {output_file}")
         
     except Exception as e:
         logger.error(f"Error saving Excel file: {str(e)}")
         raise
 
-def process_battle_chunk(battle_urls_chunk):
-    """Process a chunk of battle URLs with a single Chrome instance"""
+def process_battle_chunk(battle_urls_chunk, driver=None, on_result=None, deadline=None, recycle=None):
+    """Process a chunk of (index, url) pairs with a single Chrome instance
+
+    The chunk may be any iterable, including a generator shared by several
+    workers. on_result(index, url, is_victory, battle_data, error, scoreboard)
+    is called after every URL. URLs reached after the job deadline fail
+    without being fetched. recycle(driver, dead=False) is called after every
+    URL the browser loaded and returns the driver to continue with, so its
+    owner can swap in a fresh one; without a driver a private one is
+    launched and replaced as needed. Returned data is a list of (index, battle_data) pairs so chunks
+    can be merged back into URL order.
+    """
     chunk_data = []
     chunk_victories = 0
     chunk_defeats = 0
+    own_driver = driver is None
     
-    with create_driver() as driver:
-        for url in battle_urls_chunk:
-            is_victory, battle_data = extract_battle_data_with_retry(driver, url)
+    def replace_own_driver(old_driver, dead=False):
+        if not dead:
+            return old_driver
+        quit_driver(old_driver)
+        return setup_driver()
+    
+    if own_driver:
+        driver = setup_driver()
+        recycle = replace_own_driver
+    
+    def next_driver(old_driver, dead=False):
+        new_driver = recycle(old_driver, dead=dead)
+        if new_driver is not old_driver:
+            # The old driver is being quit along with its browser context
+            _browser_contexts.pop(old_driver, None)
+        return new_driver
+    
+    try:
+        for index, url in battle_urls_chunk:
+            error = None
+            scoreboard = None
+            loaded_before = (driver, browser_pages(driver))
+            try:
+                try:
+                    scoreboard = extract_battle_scoreboard(driver, url, deadline=deadline)
+                except DriverDead as e:
+                    if recycle is None:
+                        raise
+                    logger.warning(f"{str(e)}, retrying on a fresh driver")
+                    # Left unset if no replacement can be launched; the worker stops after reporting this URL
+                    driver, dead_driver = None, driver
+                    driver = next_driver(dead_driver, dead=True)
+                    scoreboard = extract_battle_scoreboard(driver, url, deadline=deadline)
+                view = battle_view(scoreboard, parse_battle_url(url)[1]) if scoreboard else None
+                is_victory, battle_data = view if view is not None else (None, [])
+            except Exception as e:
+                logger.error(f"Error processing battle {url}: {str(e)}")
+                is_victory, battle_data, error = None, [], e
             if battle_data:
-                chunk_data.append(battle_data)
+                chunk_data.append((index, battle_data))
                 if is_victory is not None:
                     if is_victory:
                         chunk_victories += 1
                     else:
                         chunk_defeats += 1
+            if on_result:
+                on_result(index, url, is_victory, battle_data, error, scoreboard)
+            if recycle is not None and driver is not None and (driver, browser_pages(driver)) != loaded_before:
+                # Only battles the browser loaded count towards recycling; a fresh driver may be due
+                try:
+                    driver = next_driver(driver)
+                except Exception as e:
+                    driver = None
+                    error = e
+            if driver is None:
+                # Everything up to here was reported; the URLs still queued are left to the other workers
+                raise DriverDead(f"No replacement driver could be launched, stopping this worker: {str(error)}")
+    finally:
+        if driver is not None:
+            close_browser_context(driver)
+            if own_driver:
+                quit_driver(driver)
     
     return chunk_data, chunk_victories, chunk_defeats
 
@@ -724,10 +1104,9 @@ def main():
         "https://tomato.gg/battle/64391779236043210/512317641"
     ]
     
-    # Use single thread for maximum stability
-    max_threads = 1  # Process battles sequentially
-    chunk_size = len(battle_urls)  # Process all battles in one chunk
-    url_chunks = [battle_urls]  # Single chunk containing all URLs
+    # Fan the battles out over the shared driver pool
+    from battle_runner import ANALYSIS_WORKERS, run_battle_job
+    max_threads = ANALYSIS_WORKERS
     
     all_battles_data = []
     total_victories = 0
@@ -736,37 +1115,26 @@ def main():
     failed_battles = []  # Track failed battles
     
     start_time = time.time()
-    logger.warning(f"Starting battle processing in single-threaded mode")
+    logger.warning(f"Starting battle processing with {max_threads} drivers")
     
-    try:
-        # Process all battles in a single chunk
-        with create_driver() as driver:
-            for url in battle_urls:
-                try:
-                    is_victory, battle_data = extract_battle_data_with_retry(driver, url)
-                    if battle_data:
-                        all_battles_data.append(battle_data)
-                        if is_victory is not None:
-                            if is_victory:
-                                total_victories += 1
-                            else:
-                                total_defeats += 1
-                        processed_battles += 1
-                        
-                        # Show progress
-                        elapsed_time = time.time() - start_time
-                        battles_per_second = processed_battles / elapsed_time if elapsed_time > 0 else 0
-                        logger.warning(f"Processed {processed_battles}/{len(battle_urls)} battles. "
-                                     f"Speed: {battles_per_second:.2f} battles/second")
-                    else:
-                        failed_battles.append(url)
-                        logger.error(f"Failed to process battle: {url}")
-                        
-                except Exception as e:
-                    failed_battles.append(url)
-                    logger.error(f"Error processing battle {url}: {str(e)}")
-                    continue
+    def report_progress(index, url, is_victory, battle_data, error):
+        nonlocal processed_battles
+        if battle_data:
+            processed_battles += 1
+            
+            # Show progress
+            elapsed_time = time.time() - start_time
+            battles_per_second = processed_battles / elapsed_time if elapsed_time > 0 else 0
+            logger.warning(f"Processed {processed_battles}/{len(battle_urls)} battles. "
+                         f"Speed: {battles_per_second:.2f} battles/second")
+        else:
+            failed_battles.append(url)
+            logger.error(f"Failed to process battle: {url}")
     
+    try:
+        all_battles_data, total_victories, total_defeats = run_battle_job(
+            battle_urls, on_result=report_progress, max_workers=max_threads
+        )
     except Exception as e:
         logger.error(f"Critical error during processing: {str(e)}")
     
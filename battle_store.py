@@ -0,0 +1,239 @@
+"""
+Persistent store of parsed battle results keyed by battle ID.
+
+A finished battle's scoreboard never changes, so once a battle has been
+scraped its scoreboard (result plus both team tables) is kept in a local
+SQLite database and served from there on every later request for the same
+battle, from any of its players' URLs.
+
+Battles that turned out not to exist (404/error pages) are remembered for
+a short while too, with the reason, so stale links that are pasted again
+fail without another page load.
+
+Usage:
+    python battle_store.py stats
+    python battle_store.py invalidate <battle_id or url> [...]
+    python battle_store.py invalidate --all
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import metrics
+from battle_fetch import parse_battle_url
+from battle_parser import battle_view
+from battle_record import records_from_dicts, records_to_dicts
+
+logger = logging.getLogger(__name__)
+
+BATTLE_STORE_ENABLED = os.getenv('BATTLE_STORE', '1') != '0'
+BATTLE_STORE_PATH = os.getenv('BATTLE_STORE_PATH', os.path.join('data', 'battle_store.sqlite3'))
+# Seconds before a stored battle is fetched again; 0 keeps results forever
+BATTLE_STORE_TTL = float(os.getenv('BATTLE_STORE_TTL', '0'))
+# Seconds a failed battle is answered from the store before it is tried again; 0 disables
+NEGATIVE_CACHE_TTL = float(os.getenv('NEGATIVE_CACHE_TTL', '900'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS battles (
+    battle_id TEXT PRIMARY KEY,
+    player_id TEXT,
+    is_victory INTEGER NOT NULL,
+    battle_data TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    teams TEXT
+)
+"""
+
+FAILURES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS failed_battles (
+    battle_id TEXT PRIMARY KEY,
+    reason TEXT NOT NULL,
+    failed_at REAL NOT NULL
+)
+"""
+
+
+class BattleStore:
+    """SQLite-backed battle result store with optional TTL and hit/miss counters"""
+
+    def __init__(self, path=BATTLE_STORE_PATH, ttl=BATTLE_STORE_TTL, negative_ttl=NEGATIVE_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(SCHEMA)
+            conn.execute(FAILURES_SCHEMA)
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(battles)')]
+            if 'teams' not in columns:
+                conn.execute('ALTER TABLE battles ADD COLUMN teams TEXT')
+
+    def _connection(self):
+        # sqlite3 connections may not be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get_scoreboard(self, battle_url):
+        """Return the stored scoreboard if it covers the URL's player, or None"""
+        battle_id, player_id = parse_battle_url(battle_url)
+        row = None
+        if battle_id:
+            row = self._connection().execute(
+                'SELECT player_id, is_victory, battle_data, fetched_at, teams FROM battles WHERE battle_id = ?',
+                (battle_id,)
+            ).fetchone()
+
+        scoreboard = None
+        if row is not None and not self._expired(row[3]):
+            if row[4]:
+                teams = json.loads(row[4])
+            else:
+                # Rows stored before team tables were kept only cover their own player
+                teams = [{'player_ids': [row[0]], 'battle_data': json.loads(row[2])}]
+            for team in teams:
+                team['battle_data'] = records_from_dicts(team['battle_data'])
+            scoreboard = {'battle_id': battle_id, 'player_id': row[0], 'is_victory': bool(row[1]), 'teams': teams}
+            if battle_view(scoreboard, player_id) is None:
+                scoreboard = None
+
+        if scoreboard is None:
+            self.misses += 1
+            metrics.inc('battle_store_misses')
+            return None
+        self.hits += 1
+        metrics.inc('battle_store_hits')
+        return scoreboard
+
+    def get(self, battle_url):
+        """Return the stored (is_victory, battle_data) as seen by the URL's player, or None"""
+        scoreboard = self.get_scoreboard(battle_url)
+        if scoreboard is None:
+            return None
+        return battle_view(scoreboard, parse_battle_url(battle_url)[1])
+
+    def put_scoreboard(self, scoreboard):
+        """Store a successfully parsed battle scoreboard"""
+        if not scoreboard or not scoreboard.get('battle_id') or scoreboard.get('is_victory') is None:
+            return False
+        teams = scoreboard['teams']
+        if not teams or not teams[0]['battle_data']:
+            return False
+        teams = [{'player_ids': team['player_ids'], 'battle_data': records_to_dicts(team['battle_data'])}
+                 for team in teams]
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO battles (battle_id, player_id, is_victory, battle_data, fetched_at, teams) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (scoreboard['battle_id'], scoreboard.get('player_id'), int(scoreboard['is_victory']),
+                 json.dumps(teams[0]['battle_data']), time.time(), json.dumps(teams))
+            )
+            conn.execute('DELETE FROM failed_battles WHERE battle_id = ?', (scoreboard['battle_id'],))
+        return True
+
+    def get_failure(self, battle_url):
+        """Return the reason code of a recent failure for the URL's battle, or None"""
+        battle_id, _ = parse_battle_url(battle_url)
+        if not battle_id or self.negative_ttl <= 0:
+            return None
+        row = self._connection().execute(
+            'SELECT reason, failed_at FROM failed_battles WHERE battle_id = ?', (battle_id,)
+        ).fetchone()
+        if row is None or time.time() - row[1] > self.negative_ttl:
+            return None
+        metrics.inc('negative_cache_hits')
+        return row[0]
+
+    def put_failure(self, battle_url, reason):
+        """Remember that the URL's battle could not be read, with a reason code"""
+        battle_id, _ = parse_battle_url(battle_url)
+        if not battle_id or self.negative_ttl <= 0:
+            return False
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO failed_battles (battle_id, reason, failed_at) VALUES (?, ?, ?)',
+                (battle_id, reason, time.time())
+            )
+        return True
+
+    def invalidate(self, battle_ids=None):
+        """Remove the given battles (IDs or URLs), or every battle when None; return rows removed"""
+        with self._connection() as conn:
+            if battle_ids is None:
+                conn.execute('DELETE FROM failed_battles')
+                return conn.execute('DELETE FROM battles').rowcount
+            removed = 0
+            for battle_id in battle_ids:
+                parsed_id, _ = parse_battle_url(battle_id)
+                conn.execute('DELETE FROM failed_battles WHERE battle_id = ?', (parsed_id or battle_id,))
+                removed += conn.execute('DELETE FROM battles WHERE battle_id = ?', (parsed_id or battle_id,)).rowcount
+            return removed
+
+    def stats(self):
+        """Return stored battle and failure counts and this process's hit/miss counters"""
+        conn = self._connection()
+        count = conn.execute('SELECT COUNT(*) FROM battles').fetchone()[0]
+        failed = conn.execute('SELECT COUNT(*) FROM failed_battles WHERE failed_at > ?',
+                              (time.time() - self.negative_ttl,)).fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'battles': count,
+            'failed_battles': failed,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0
+        }
+
+    def _expired(self, fetched_at):
+        return self.ttl > 0 and time.time() - fetched_at > self.ttl
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_battle_store():
+    """Return the process-wide battle store, or None when disabled"""
+    global _store
+    if not BATTLE_STORE_ENABLED:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = BattleStore()
+        return _store
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ('stats', 'invalidate'):
+        print(__doc__.strip().split('Usage:')[1])
+        sys.exit(1)
+
+    store = BattleStore()
+    if sys.argv[1] == 'stats':
+        print(json.dumps(store.stats(), indent=2))
+        return
+
+    targets = sys.argv[2:]
+    if not targets:
+        print("Give battle IDs/URLs to invalidate, or --all")
+        sys.exit(1)
+    removed = store.invalidate(None if targets == ['--all'] else targets)
+    print(f"Invalidated {removed} stored battles")
+
+
+if __name__ == "__main__":
+    main()
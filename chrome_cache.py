@@ -0,0 +1,77 @@
+"""
+Persistent Chrome disk cache directories shared across driver instances.
+
+Chrome cannot safely share one cache directory between running browsers, so
+the cache root is split into numbered slots. A driver claims a free slot
+when it launches and gives it back when it quits; the driver that replaces
+it (after a recycle, or in the next job) reuses the slot and finds
+tomato.gg's scripts and styles already on disk. Slots are claimed with
+exclusive file locks, so worker processes on one machine never share one.
+"""
+
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: slots are only coordinated between threads
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Root directory for the per-slot caches; empty disables the persistent cache
+CHROME_CACHE_DIR = os.getenv('CHROME_CACHE_DIR', '')
+# Size cap Chrome applies to each slot's cache
+CHROME_CACHE_SIZE_MB = int(os.getenv('CHROME_CACHE_SIZE_MB', '256'))
+MAX_CACHE_SLOTS = 64
+
+_claimed = set()
+_claimed_lock = threading.Lock()
+
+
+class CacheSlot:
+    """A claimed cache directory; release() hands it to the next driver"""
+
+    def __init__(self, index, path, lock_file):
+        self.index = index
+        self.path = path
+        self._lock_file = lock_file
+
+    def chrome_arguments(self):
+        return [f'--disk-cache-dir={self.path}', f'--disk-cache-size={CHROME_CACHE_SIZE_MB * 1024 * 1024}']
+
+    def release(self):
+        with _claimed_lock:
+            if self._lock_file is None:
+                return
+            if fcntl:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+            _claimed.discard(self.index)
+
+
+def claim_cache_slot(root=CHROME_CACHE_DIR):
+    """Claim the lowest free cache slot under root, or return None when disabled or all are taken"""
+    if not root:
+        return None
+    os.makedirs(root, exist_ok=True)
+    with _claimed_lock:
+        for index in range(MAX_CACHE_SLOTS):
+            if index in _claimed:
+                continue
+            lock_file = open(os.path.join(root, f'slot-{index}.lock'), 'a')
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # Held by a driver in another process
+                    lock_file.close()
+                    continue
+            _claimed.add(index)
+            path = os.path.join(root, f'slot-{index}')
+            os.makedirs(path, exist_ok=True)
+            return CacheSlot(index, path, lock_file)
+    logger.warning(f"All {MAX_CACHE_SLOTS} Chrome cache slots are in use, launching without a persistent cache")
+    return None
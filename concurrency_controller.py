@@ -0,0 +1,160 @@
+"""
+Adaptive request rate and page-load concurrency for tomato.gg.
+
+An AIMD controller watches the outcome and latency of every page load. Each
+window of healthy loads that stays under the latency target raises the
+request rate by a fixed step and allows one more page load in flight; a
+timeout, a rate-limited page, an error or a window that ran slow cuts both
+by a factor at once. The request rate is applied to the shared token buckets
+in rate_limiter, and page loads take a slot from the controller, so
+throughput follows what the site can take instead of a fixed setpoint.
+"""
+
+import logging
+import os
+import threading
+import time
+
+import metrics
+from rate_limiter import RATE_LIMIT_PER_MINUTE, get_rate_limiter
+from retry_policy import SITE_FAILURES, DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+# Set to 0 to keep the fixed RATE_LIMIT_PER_MINUTE and no page-load limit
+ADAPTIVE_CONCURRENCY = os.getenv('ADAPTIVE_CONCURRENCY', '1') != '0'
+ADAPTIVE_MIN_RATE = float(os.getenv('ADAPTIVE_MIN_RATE', '6'))
+ADAPTIVE_MAX_RATE = float(os.getenv('ADAPTIVE_MAX_RATE', '180'))
+# Requests per minute added after each healthy window
+ADAPTIVE_RATE_STEP = float(os.getenv('ADAPTIVE_RATE_STEP', '5'))
+# Page loads in flight across the process, whatever the number of drivers and tabs
+ADAPTIVE_MAX_CONCURRENCY = int(os.getenv('ADAPTIVE_MAX_CONCURRENCY', '8'))
+# Page loads allowed in flight at first, from which the limit grows; defaults to one per job worker
+ADAPTIVE_INITIAL_CONCURRENCY = int(os.getenv('ADAPTIVE_INITIAL_CONCURRENCY',
+                                             os.getenv('ANALYSIS_WORKERS', os.getenv('DRIVER_POOL_SIZE', '2'))))
+# Factor rate and concurrency are multiplied by under stress
+ADAPTIVE_BACKOFF = float(os.getenv('ADAPTIVE_BACKOFF', '0.5'))
+# Mean seconds per page load above which a window counts as stress
+ADAPTIVE_LATENCY_TARGET = float(os.getenv('ADAPTIVE_LATENCY_TARGET', '8'))
+# Healthy page loads per increase
+ADAPTIVE_WINDOW = int(os.getenv('ADAPTIVE_WINDOW', '10'))
+# Failures from loads already in flight when the setpoint was cut do not cut it again
+DECREASE_COOLDOWN = 5.0
+
+
+class ConcurrencyController:
+    """AIMD setpoint for the request rate and the number of page loads in flight"""
+
+    def __init__(self, rate=RATE_LIMIT_PER_MINUTE, min_rate=ADAPTIVE_MIN_RATE, max_rate=ADAPTIVE_MAX_RATE,
+                 rate_step=ADAPTIVE_RATE_STEP, max_concurrency=ADAPTIVE_MAX_CONCURRENCY, backoff=ADAPTIVE_BACKOFF,
+                 latency_target=ADAPTIVE_LATENCY_TARGET, window=ADAPTIVE_WINDOW, enabled=ADAPTIVE_CONCURRENCY,
+                 initial_concurrency=ADAPTIVE_INITIAL_CONCURRENCY):
+        self.min_rate = min_rate
+        self.max_rate = max(min_rate, max_rate)
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+        self.rate_step = rate_step
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = min(self.max_concurrency, max(1, initial_concurrency))
+        self.backoff = backoff
+        self.latency_target = latency_target
+        self.window = max(1, window)
+        self.enabled = enabled
+        self.in_flight = 0
+        self._latencies = []
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+        if self.enabled:
+            self._apply()
+
+    def acquire(self, deadline=None):
+        """Block until a page load may start, raising DeadlineExceeded if the deadline comes first"""
+        with self._condition:
+            while self.enabled and self.in_flight >= self.concurrency:
+                remaining = deadline.remaining() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise DeadlineExceeded(f"No page load slot free within the deadline ({self.concurrency} in flight)")
+                # A deadline without a budget has infinite time left, which Condition.wait does not take
+                self._condition.wait(None if remaining == float('inf') else remaining)
+            self.in_flight += 1
+            metrics.set_gauge('adaptive_in_flight', self.in_flight)
+
+    def try_acquire(self):
+        """Take a page load slot if one is free; return whether it was taken"""
+        with self._condition:
+            if self.enabled and self.in_flight >= self.concurrency:
+                return False
+            self.in_flight += 1
+            metrics.set_gauge('adaptive_in_flight', self.in_flight)
+            return True
+
+    def release(self):
+        with self._condition:
+            self.in_flight = max(0, self.in_flight - 1)
+            metrics.set_gauge('adaptive_in_flight', self.in_flight)
+            self._condition.notify()
+
+    def record(self, latency=None, failure=None):
+        """Feed one page load outcome; failure None means success, latency is in seconds"""
+        if not self.enabled:
+            return
+        with self._condition:
+            if failure in SITE_FAILURES:
+                self._decrease(failure)
+            elif failure is None and latency is not None:
+                self._latencies.append(latency)
+                if len(self._latencies) >= self.window:
+                    mean = sum(self._latencies) / len(self._latencies)
+                    if mean > self.latency_target:
+                        self._decrease(f"mean page load {mean:.1f}s")
+                    else:
+                        self._increase()
+            # Missing battles and dead drivers say nothing about the site's load
+
+    def _increase(self):
+        self._latencies = []
+        rate = min(self.max_rate, self.rate + self.rate_step)
+        concurrency = min(self.max_concurrency, self.concurrency + 1)
+        if (rate, concurrency) != (self.rate, self.concurrency):
+            self.rate, self.concurrency = rate, concurrency
+            self._apply()
+            self._condition.notify_all()
+
+    def _decrease(self, reason):
+        self._latencies = []
+        now = time.time()
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.backoff)
+        self.concurrency = max(1, int(self.concurrency * self.backoff))
+        logger.warning(f"Backing off from tomato.gg ({reason}): {self.rate:.0f} requests/min, "
+                       f"{self.concurrency} page loads at once")
+        metrics.inc('adaptive_decreases')
+        self._apply()
+
+    def _apply(self):
+        get_rate_limiter().set_rate(self.rate)
+        metrics.set_gauge('adaptive_rate_per_minute', round(self.rate, 2))
+        metrics.set_gauge('adaptive_concurrency', self.concurrency)
+
+    def status(self):
+        with self._condition:
+            return {
+                'enabled': self.enabled,
+                'rate_per_minute': round(self.rate, 2),
+                'concurrency': self.concurrency,
+                'in_flight': self.in_flight
+            }
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_concurrency_controller():
+    """Return the process-wide concurrency controller"""
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = ConcurrencyController()
+        return _controller
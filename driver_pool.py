@@ -0,0 +1,341 @@
+"""
+Warm Chrome driver pool shared across battle processing jobs.
+
+Launching headless Chrome is the slowest part of a small job, so a pool of
+pre-warmed drivers is kept alive between /process requests. Jobs lease a
+driver, return it when done, and dead drivers are replaced in the background.
+
+Chrome's memory grows over hundreds of pages, so drivers are also recycled
+before they degrade: after DRIVER_MAX_PAGES pages, DRIVER_MAX_AGE seconds or
+once their process tree uses more than DRIVER_MAX_RSS_MB.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import metrics
+from battle_scraper import quit_driver, setup_driver
+
+try:
+    import psutil
+except ImportError:  # Memory-based recycling is skipped without psutil
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+# Pool configuration (overridable through the environment)
+DRIVER_POOL_SIZE = int(os.getenv('DRIVER_POOL_SIZE', '2'))
+DRIVER_POOL_MIN_IDLE = int(os.getenv('DRIVER_POOL_MIN_IDLE', '1'))
+DRIVER_LEASE_TIMEOUT = float(os.getenv('DRIVER_LEASE_TIMEOUT', '120'))
+DRIVER_IDLE_TIMEOUT = float(os.getenv('DRIVER_IDLE_TIMEOUT', '600'))
+REAPER_INTERVAL = 30
+# Recycling thresholds; 0 disables a check
+DRIVER_MAX_PAGES = int(os.getenv('DRIVER_MAX_PAGES', '200'))
+DRIVER_MAX_AGE = float(os.getenv('DRIVER_MAX_AGE', '1800'))
+DRIVER_MAX_RSS_MB = float(os.getenv('DRIVER_MAX_RSS_MB', '1024'))
+# Walking the process tree costs a few ms, so memory is sampled every few pages
+RSS_CHECK_INTERVAL = 10
+RSS_BUCKETS = (128, 256, 512, 768, 1024, 1536, 2048, 4096)
+
+
+class DriverPoolTimeout(Exception):
+    """Raised when no driver could be leased within the lease timeout"""
+
+
+def driver_rss_mb(driver):
+    """Resident memory of the driver's chromedriver + Chrome process tree in MB, or None"""
+    if psutil is None:
+        return None
+    try:
+        root = psutil.Process(driver.service.process.pid)
+        processes = [root] + root.children(recursive=True)
+    except (AttributeError, psutil.Error):
+        return None
+    rss = 0
+    for process in processes:
+        try:
+            rss += process.memory_info().rss
+        except psutil.Error:
+            continue
+    return rss / (1024 * 1024)
+
+
+class DriverLease:
+    """A leased pool slot whose driver may be swapped for a fresh one between pages"""
+
+    def __init__(self, pool, driver):
+        self.pool = pool
+        self.driver = driver
+
+    def checkpoint(self, dead=False):
+        """Count a finished page and recycle the driver if it is due; return the driver to use next"""
+        reason = 'dead' if dead else self.pool.note_page(self.driver)
+        if reason:
+            driver, self.driver = self.driver, None
+            self.driver = self.pool.replace(driver, reason)
+        return self.driver
+
+
+class DriverPool:
+    """Keeps a set of warm Chrome drivers and leases them to jobs"""
+
+    def __init__(self, size=DRIVER_POOL_SIZE, lease_timeout=DRIVER_LEASE_TIMEOUT,
+                 idle_timeout=DRIVER_IDLE_TIMEOUT, min_idle=DRIVER_POOL_MIN_IDLE,
+                 factory=setup_driver, max_pages=DRIVER_MAX_PAGES, max_age=DRIVER_MAX_AGE,
+                 max_rss_mb=DRIVER_MAX_RSS_MB):
+        self.size = max(1, size)
+        self.lease_timeout = lease_timeout
+        self.idle_timeout = idle_timeout
+        self.min_idle = min(max(0, min_idle), self.size)
+        self.factory = factory
+        self.max_pages = max_pages
+        self.max_age = max_age
+        self.max_rss_mb = max_rss_mb
+        self._usage = {}  # driver -> {'started': launch time, 'pages': pages served}
+        self._recycled = 0
+        self._idle = deque()  # (driver, last_used) pairs, most recently used last
+        self._total = 0  # idle + leased + launching drivers
+        self._cond = threading.Condition()
+        self._closed = False
+        self._reaper = None
+
+    def start(self):
+        """Pre-warm the pool and start the idle reaper"""
+        with self._cond:
+            missing = self.size - self._total
+            self._total += missing
+        for _ in range(missing):
+            self._spawn_replacement()
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap_loop, name='driver-pool-reaper')
+            self._reaper.daemon = True
+            self._reaper.start()
+        logger.warning(f"Driver pool started with {missing} warming drivers (size={self.size})")
+        return self
+
+    def acquire(self, timeout=None):
+        """Lease a driver, launching one on demand if the pool has spare capacity"""
+        timeout = self.lease_timeout if timeout is None else timeout
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise DriverPoolTimeout("Driver pool is shut down")
+                if self._idle:
+                    driver, _ = self._idle.pop()
+                    return driver
+                if self._total < self.size:
+                    self._total += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise DriverPoolTimeout(f"No driver available after {timeout:.0f}s")
+                self._cond.wait(remaining)
+
+        # Spare capacity but nothing warm: pay for the launch in the caller
+        try:
+            return self._launch()
+        except Exception:
+            with self._cond:
+                self._total -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, driver):
+        """Return a leased driver, replacing it in the background if it died or is due for recycling"""
+        if driver is None:
+            return
+        reason = self.recycle_reason(driver)
+        if reason:
+            self._count_recycle(reason)
+            self._forget(driver)
+            threading.Thread(target=self._quit, args=(driver,), daemon=True).start()
+            self._spawn_replacement()
+            return
+        if self._is_healthy(driver):
+            with self._cond:
+                if not self._closed:
+                    self._idle.append((driver, time.time()))
+                    self._cond.notify()
+                    return
+                self._total -= 1
+            self._forget(driver)
+            self._quit(driver)
+            return
+
+        logger.warning("Returned driver failed health check, replacing it")
+        self._forget(driver)
+        threading.Thread(target=self._quit, args=(driver,), daemon=True).start()
+        self._spawn_replacement()
+
+    @contextmanager
+    def lease(self, timeout=None):
+        """Context manager that leases a slot as a DriverLease and always returns its driver"""
+        lease = DriverLease(self, self.acquire(timeout))
+        try:
+            yield lease
+        finally:
+            self.release(lease.driver)
+
+    def note_page(self, driver):
+        """Count a page served by a leased driver; return why it should be recycled, or None"""
+        with self._cond:
+            usage = self._usage.get(driver)
+            if usage is None:
+                return None
+            usage['pages'] += 1
+            check_memory = usage['pages'] % RSS_CHECK_INTERVAL == 0
+        return self.recycle_reason(driver, check_memory)
+
+    def recycle_reason(self, driver, check_memory=True):
+        """Return 'pages', 'age' or 'memory' if the driver is due for recycling, else None"""
+        with self._cond:
+            usage = self._usage.get(driver)
+            if usage is None:
+                return None
+            pages, started = usage['pages'], usage['started']
+        if self.max_pages and pages >= self.max_pages:
+            return 'pages'
+        if self.max_age and time.time() - started >= self.max_age:
+            return 'age'
+        if check_memory and self.max_rss_mb:
+            rss = driver_rss_mb(driver)
+            if rss is not None:
+                metrics.observe('driver_rss_mb', rss, RSS_BUCKETS)
+                if rss >= self.max_rss_mb:
+                    return 'memory'
+        return None
+
+    def replace(self, driver, reason):
+        """Quit a leased driver and launch a fresh one in the same slot"""
+        self._count_recycle(reason)
+        self._forget(driver)
+        logger.warning(f"Recycling driver ({reason})")
+        threading.Thread(target=self._quit, args=(driver,), daemon=True).start()
+        try:
+            return self._launch()
+        except Exception:
+            with self._cond:
+                self._total -= 1
+                self._cond.notify()
+            raise
+
+    def stats(self):
+        """Return current pool occupancy and recycling counts"""
+        with self._cond:
+            idle = len(self._idle)
+            pages = [usage['pages'] for usage in self._usage.values()]
+            return {
+                'size': self.size,
+                'total': self._total,
+                'idle': idle,
+                'leased_or_launching': self._total - idle,
+                'recycled': self._recycled,
+                'max_driver_pages': max(pages) if pages else 0
+            }
+
+    def shutdown(self):
+        """Quit every idle driver and refuse further leases"""
+        with self._cond:
+            self._closed = True
+            drivers = [driver for driver, _ in self._idle]
+            self._idle.clear()
+            for driver in drivers:
+                self._usage.pop(driver, None)
+            self._total -= len(drivers)
+            self._cond.notify_all()
+        for driver in drivers:
+            self._quit(driver)
+
+    def _spawn_replacement(self):
+        """Launch a driver in the background to fill a slot already counted in _total"""
+        thread = threading.Thread(target=self._launch_into_pool, name='driver-pool-launcher')
+        thread.daemon = True
+        thread.start()
+
+    def _launch(self):
+        """Launch a driver and start tracking its usage"""
+        started = time.time()
+        driver = self.factory()
+        with self._cond:
+            self._usage[driver] = {'started': started, 'pages': 0}
+        return driver
+
+    def _forget(self, driver):
+        with self._cond:
+            self._usage.pop(driver, None)
+
+    def _count_recycle(self, reason):
+        with self._cond:
+            self._recycled += 1
+        metrics.inc(f'driver_recycles.{reason}')
+
+    def _launch_into_pool(self):
+        try:
+            driver = self._launch()
+        except Exception as e:
+            logger.error(f"Driver pool failed to launch a driver: {str(e)}")
+            with self._cond:
+                self._total -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            if not self._closed:
+                self._idle.append((driver, time.time()))
+                self._cond.notify()
+                return
+            self._total -= 1
+        self._quit(driver)
+
+    def _reap_loop(self):
+        while not self._closed:
+            time.sleep(REAPER_INTERVAL)
+            self.evict_idle()
+
+    def evict_idle(self):
+        """Quit drivers idle longer than idle_timeout, keeping min_idle warm"""
+        now = time.time()
+        evicted = []
+        with self._cond:
+            # Oldest drivers sit at the left end of the deque
+            while len(self._idle) > self.min_idle and now - self._idle[0][1] > self.idle_timeout:
+                driver, _ = self._idle.popleft()
+                evicted.append(driver)
+                self._usage.pop(driver, None)
+            self._total -= len(evicted)
+        for driver in evicted:
+            self._quit(driver)
+        if evicted:
+            logger.warning(f"Evicted {len(evicted)} idle drivers from pool")
+        return len(evicted)
+
+    @staticmethod
+    def _is_healthy(driver):
+        try:
+            driver.execute_script('return 1')
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _quit(driver):
+        quit_driver(driver)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_driver_pool():
+    """Return the process-wide driver pool, starting it on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = DriverPool().start()
+            atexit.register(_pool.shutdown)
+        return _pool
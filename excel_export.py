@@ -0,0 +1,175 @@
+"""
+Bulk Excel export of player averages.
+
+The averages sheet is written in a single pass: rows are sorted and turned
+into plain value lists up front, each row goes out with a few write_row
+calls (one per run of columns sharing a format), and every format object is
+created once and reused. Large reports switch xlsxwriter to constant_memory
+mode, which streams finished rows to disk instead of holding the whole sheet
+in memory. The layout is the one save_averages_to_excel has always produced.
+
+Writing the cells takes linear time, but the whole export does not.
+xlsxwriter places each Tank List comment by adding up the height of every
+row above it once row heights differ from Excel's default, and the sheet's
+20pt rows (set_default_row) make them differ. There is no public option to
+avoid that walk, so time grows with the square of the row count. About 5k
+rows take 5 seconds, 20k rows take over a minute, and 50k-player reports
+take several minutes rather than seconds.
+
+render_averages_workbook renders the same sheet into memory for downloads
+that are streamed straight to the response without touching the disk.
+"""
+
+import io
+import logging
+import os
+
+import pandas as pd
+import xlsxwriter
+
+logger = logging.getLogger(__name__)
+
+# Rows from which the workbook streams rows to disk instead of keeping them in memory
+CONSTANT_MEMORY_ROWS = int(os.getenv('EXCEL_CONSTANT_MEMORY_ROWS', '5000'))
+
+SHEET_NAME = 'Player Averages'
+COLUMN_WIDTHS = {
+    'Name': 30,
+    'Battles': 10,
+    'Avg Damage': 12,
+    'Avg Frags': 10,
+    'Avg Assist': 12,
+    'Avg Spots': 10,
+    'Avg XP': 10,
+    'Tanks Used': 12,
+    'Tank List': 35,  # Fixed width for tank list
+    'Hit Rate': 10,
+    'Pen Rate': 10,
+    'Avg Survival': 12
+}
+# Numeric columns written as plain cells rather than with the one-decimal number format
+COUNT_COLUMNS = ('Battles', 'Tanks Used')
+TANK_LIST_PREVIEW = 50
+
+FORMATS = {
+    'header': {
+        'bold': True,
+        'bg_color': '#4B5320',
+        'font_color': 'white',
+        'border': 1,
+        'align': 'center',
+        'text_wrap': True,
+        'valign': 'vcenter'
+    },
+    'cell': {
+        'border': 1,
+        'align': 'left',
+        'valign': 'vcenter',
+        'text_wrap': False  # Disable text wrapping for tank list
+    },
+    'number': {
+        'border': 1,
+        'align': 'center',
+        'valign': 'vcenter',
+        'num_format': '#,##0.0'
+    },
+    'band': {
+        'bg_color': '#F0F0F0',
+        'border': 1,
+        'text_wrap': False,
+        'valign': 'vcenter'
+    },
+    'summary': {
+        'bold': True,
+        'align': 'left',
+        'valign': 'vcenter',
+        'font_size': 11
+    }
+}
+
+
+class FormatCache:
+    """Creates each named format once per workbook"""
+
+    def __init__(self, workbook):
+        self.workbook = workbook
+        self._formats = {}
+
+    def __getitem__(self, name):
+        if name not in self._formats:
+            self._formats[name] = self.workbook.add_format(FORMATS[name])
+        return self._formats[name]
+
+
+def sorted_rows(averages_data):
+    """Return the averages rows by Avg Damage, highest first, in the order the sheet has always used"""
+    order = pd.Series([row['Avg Damage'] for row in averages_data]).sort_values(ascending=False).index
+    return [averages_data[position] for position in order]
+
+
+def column_runs(columns, first_row):
+    """Group adjacent columns that share a format into (first_col, last_col, format name) runs"""
+    runs = []
+    for col, column in enumerate(columns):
+        value = first_row[column]
+        is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+        name = 'number' if is_number and column not in COUNT_COLUMNS else 'cell'
+        if runs and runs[-1][2] == name:
+            runs[-1][1] = col
+        else:
+            runs.append([col, col, name])
+    return runs
+
+
+def write_averages_workbook(averages_data, output, battle_summary=None):
+    """Write the averages sheet to output, a file path or a writable binary file object"""
+    rows = sorted_rows(averages_data)
+    columns = list(rows[0].keys())
+    tank_col = columns.index('Tank List') if 'Tank List' in columns else None
+
+    # constant_memory streams rows through a temp file; smaller sheets are assembled in memory
+    constant_memory = len(rows) >= CONSTANT_MEMORY_ROWS
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': constant_memory, 'in_memory': not constant_memory})
+    formats = FormatCache(workbook)
+    worksheet = workbook.add_worksheet(SHEET_NAME)
+
+    for col_num, column in enumerate(columns):
+        worksheet.set_column(col_num, col_num, COLUMN_WIDTHS.get(column, 15))
+    worksheet.set_default_row(20)
+    worksheet.write_row(0, 0, columns, formats['header'])
+
+    runs = column_runs(columns, rows[0])
+    for row_num, row in enumerate(rows, 1):
+        values = [row[column] for column in columns]
+        if tank_col is not None:
+            # Compact list in the cell, truncated, with the full list one per line in a comment
+            tank_list = str(values[tank_col]).replace(', ', ',')
+            worksheet.write_comment(row_num, tank_col, tank_list.replace(',', '\n'), {'width': 200, 'height': 100})
+            values[tank_col] = tank_list[:TANK_LIST_PREVIEW - 3] + "..." if len(tank_list) > TANK_LIST_PREVIEW else tank_list
+        if row_num % 2 == 1:
+            # Alternating row colour; set before the row's cells so it survives constant_memory streaming
+            worksheet.set_row(row_num, None, formats['band'])
+        for first_col, last_col, name in runs:
+            worksheet.write_row(row_num, first_col, values[first_col:last_col + 1], formats[name])
+
+    # Add battle summary below the main table if provided
+    if battle_summary:
+        summary_text = (
+            f"Battle Summary - "
+            f"Total Battles: {battle_summary['total_battles']}  |  "
+            f"Victories: {battle_summary['victories']}  |  "
+            f"Defeats: {battle_summary['defeats']}  |  "
+            f"Win Rate: {battle_summary['win_rate']:.1f}%"
+        )
+        summary_row = len(rows) + 3
+        worksheet.merge_range(summary_row, 0, summary_row, len(columns) - 1, summary_text, formats['summary'])
+
+    workbook.close()
+
+
+def render_averages_workbook(averages_data, battle_summary=None):
+    """Render the averages sheet into a BytesIO positioned at its start"""
+    buffer = io.BytesIO()
+    write_averages_workbook(averages_data, buffer, battle_summary)
+    buffer.seek(0)
+    return buffer
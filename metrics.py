@@ -0,0 +1,70 @@
+"""
+In-process metrics for the scraper: counters, gauges and histograms.
+
+Values are kept in memory and exposed as a JSON snapshot through the
+/metrics route of the web app.
+"""
+
+import threading
+from collections import defaultdict
+
+# Upper bounds (seconds) used by histograms unless a metric passes its own
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_histograms = {}
+
+
+def inc(name, value=1):
+    """Increase a counter"""
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name, value):
+    """Set a gauge to its current value"""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS):
+    """Record one observation in a histogram"""
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = {'buckets': list(buckets), 'counts': [0] * (len(buckets) + 1), 'count': 0, 'sum': 0.0}
+            _histograms[name] = histogram
+        index = len(histogram['buckets'])
+        for i, bound in enumerate(histogram['buckets']):
+            if value <= bound:
+                index = i
+                break
+        histogram['counts'][index] += 1
+        histogram['count'] += 1
+        histogram['sum'] += value
+
+
+def get_counter(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot():
+    """Return a JSON-serialisable copy of every metric"""
+    with _lock:
+        histograms = {}
+        for name, histogram in _histograms.items():
+            labels = [f"le_{bound}" for bound in histogram['buckets']] + ['le_inf']
+            histograms[name] = {
+                'count': histogram['count'],
+                'sum': round(histogram['sum'], 4),
+                'avg': round(histogram['sum'] / histogram['count'], 4) if histogram['count'] else 0,
+                'buckets': dict(zip(labels, histogram['counts']))
+            }
+        return {
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'histograms': histograms
+        }
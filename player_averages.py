@@ -0,0 +1,167 @@
+"""
+Per-player averages across many battles.
+
+All player rows of all battles go into one columnar frame built from the
+already parsed battle_record.BattleRecord fields, and the per-player sums
+come from a single groupby. Only the final formatting runs once per player,
+so season-long histories no longer cost a Python loop with string parsing
+per row.
+
+PlayerAggregate keeps the same per-player sums as a running accumulator.
+Battles can be added one at a time, accumulators from separate chunks or
+sessions merge in O(players), and they serialize to JSON so they can be
+stored with an analysis and combined later.
+"""
+
+import json
+from operator import attrgetter
+
+import numpy as np
+import pandas as pd
+
+TOTAL_COLUMNS = ['total_damage', 'total_frags', 'total_assist', 'total_spots', 'total_xp',
+                 'accuracy_shots', 'accuracy_hits', 'accuracy_pens', 'survival_time']
+# BattleRecord attributes summed into TOTAL_COLUMNS, in the same order
+RECORD_FIELDS = attrgetter('damage', 'frags', 'assist', 'spots', 'xp', 'shots', 'hits', 'pens', 'survival_seconds')
+
+
+def battle_frame(all_battles_data):
+    """Build one frame of every player row with Name, Tank and the numbers summed per player"""
+    records = [record for battle_data in all_battles_data for record in battle_data]
+    numbers = np.array([RECORD_FIELDS(record) for record in records], dtype='int64').reshape(-1, len(TOTAL_COLUMNS))
+    frame = pd.DataFrame(numbers, columns=TOTAL_COLUMNS)
+    # Plain object columns: converting to a string dtype would cost more than the grouping
+    frame.insert(0, 'Tank', pd.Series([record.tank for record in records], dtype=object))
+    frame.insert(0, 'Name', pd.Series([record.name for record in records], dtype=object))
+    return frame
+
+
+def player_totals(frame):
+    """Sum a battle frame per player, in order of first appearance, with the sorted list of tanks played"""
+    grouped = frame.groupby('Name', sort=False)
+    totals = grouped[TOTAL_COLUMNS].sum()
+    totals.insert(0, 'battles', grouped.size())
+    tanks = frame[['Name', 'Tank']].drop_duplicates().sort_values('Tank', kind='stable')
+    totals['tanks'] = tanks.groupby('Name', sort=False)['Tank'].agg(list).reindex(totals.index)
+    return totals
+
+
+def average_row(name, stats):
+    """Format one player's summed stats as a row of the averages sheet"""
+    battles = int(stats['battles'])
+    avg_stats = {
+        'Name': name,
+        'Battles': battles,
+        'Avg Damage': round(int(stats['total_damage']) / battles, 1),
+        'Avg Frags': round(int(stats['total_frags']) / battles, 2),
+        'Avg Assist': round(int(stats['total_assist']) / battles, 1),
+        'Avg Spots': round(int(stats['total_spots']) / battles, 2),
+        'Avg XP': round(int(stats['total_xp']) / battles, 1),
+        'Tanks Used': len(stats['tanks']),
+        'Tank List': ', '.join(sorted(stats['tanks'])),
+    }
+
+    # Hit rate is hits / shots, pen rate is pens / hits
+    shots, hits, pens = int(stats['accuracy_shots']), int(stats['accuracy_hits']), int(stats['accuracy_pens'])
+    if shots > 0:
+        hit_rate = (hits / shots) * 100
+        pen_rate = (pens / hits) * 100 if hits > 0 else 0
+        avg_stats['Hit Rate'] = f"{hit_rate:.1f}%"
+        avg_stats['Pen Rate'] = f"{pen_rate:.1f}%"
+    else:
+        avg_stats['Hit Rate'] = "N/A"
+        avg_stats['Pen Rate'] = "N/A"
+
+    avg_survival_seconds = int(stats['survival_time']) / battles
+    avg_stats['Avg Survival'] = f"{int(avg_survival_seconds // 60)}:{int(avg_survival_seconds % 60):02d}"
+    return avg_stats
+
+
+class PlayerAggregate:
+    """Per-player sums across battles; add_battle and merge are associative, finalize gives averages rows"""
+
+    SERIAL_VERSION = 1
+
+    def __init__(self):
+        # name -> {'battles': n, <TOTAL_COLUMNS>: sums, 'tanks': set}, in order of first appearance
+        self.players = {}
+
+    @classmethod
+    def from_battles(cls, all_battles_data):
+        """Build an aggregate from many battles at once with the vectorized groupby"""
+        aggregate = cls()
+        frame = battle_frame(all_battles_data)
+        if frame.empty:
+            return aggregate
+        totals = player_totals(frame)
+        for name, stats in zip(totals.index, totals.to_dict('records')):
+            entry = {column: int(stats[column]) for column in ['battles'] + TOTAL_COLUMNS}
+            entry['tanks'] = set(stats['tanks'])
+            aggregate.players[name] = entry
+        return aggregate
+
+    def _entry(self, name):
+        entry = self.players.get(name)
+        if entry is None:
+            entry = dict.fromkeys(['battles'] + TOTAL_COLUMNS, 0)
+            entry['tanks'] = set()
+            self.players[name] = entry
+        return entry
+
+    def add_battle(self, battle_data):
+        """Add one battle's BattleRecords; returns the names of the players it touched"""
+        for record in battle_data:
+            entry = self._entry(record.name)
+            entry['battles'] += 1
+            for column, value in zip(TOTAL_COLUMNS, RECORD_FIELDS(record)):
+                entry[column] += value
+            entry['tanks'].add(record.tank)
+        return [record.name for record in battle_data]
+
+    def merge(self, other):
+        """Add another aggregate's sums into this one; players new to this one keep other's order"""
+        for name, other_entry in other.players.items():
+            entry = self._entry(name)
+            for column in ['battles'] + TOTAL_COLUMNS:
+                entry[column] += other_entry[column]
+            entry['tanks'] |= other_entry['tanks']
+        return self
+
+    def finalize(self, names=None):
+        """Return averages rows for every player, or only for names, in order of first appearance"""
+        if names is None:
+            return [average_row(name, entry) for name, entry in self.players.items() if entry['battles']]
+        names = set(names)
+        return [average_row(name, entry) for name, entry in self.players.items()
+                if name in names and entry['battles']]
+
+    def serialize(self):
+        """Return the aggregate as a JSON string"""
+        columns = ['battles'] + TOTAL_COLUMNS
+        return json.dumps({
+            'version': self.SERIAL_VERSION,
+            'columns': columns,
+            'players': [[name, [entry[column] for column in columns], sorted(entry['tanks'])]
+                        for name, entry in self.players.items()]
+        })
+
+    @classmethod
+    def deserialize(cls, text):
+        """Rebuild an aggregate from serialize() output"""
+        data = json.loads(text)
+        if data.get('version') != cls.SERIAL_VERSION:
+            raise ValueError(f"Unsupported aggregate version: {data.get('version')}")
+        aggregate = cls()
+        for name, values, tanks in data['players']:
+            entry = dict(zip(data['columns'], values))
+            entry['tanks'] = set(tanks)
+            aggregate.players[name] = entry
+        return aggregate
+
+    def __len__(self):
+        return len(self.players)
+
+
+def calculate_averages(all_battles_data):
+    """Calculate average stats for each player across all battles"""
+    return PlayerAggregate.from_battles(all_battles_data).finalize()
@@ -0,0 +1,160 @@
+"""
+Process-safe token-bucket rate limiting per remote host.
+
+Each host has a bucket whose state (tokens left, last refill time) lives in a
+small file under RATE_LIMIT_DIR guarded by an exclusive file lock, so every
+thread and every worker process on the machine draws from the same budget.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: buckets are only shared between threads
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = 'tomato.gg'
+RATE_LIMIT_PER_MINUTE = float(os.getenv('RATE_LIMIT_PER_MINUTE', '60'))
+# Tokens a bucket can hold; bounds how many requests may go out back to back
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', '3'))
+RATE_LIMIT_DIR = os.getenv('RATE_LIMIT_DIR', os.path.join(tempfile.gettempdir(), 'wot_rate_limits'))
+
+
+class TokenBucket:
+    """Token bucket for one host, refilled continuously at rate_per_minute"""
+
+    def __init__(self, host, rate_per_minute=RATE_LIMIT_PER_MINUTE, capacity=RATE_LIMIT_BURST, state_dir=RATE_LIMIT_DIR):
+        self.host = host
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, capacity)
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, f"{host.replace(':', '_')}.bucket")
+        self._thread_lock = threading.Lock()
+
+    @contextmanager
+    def _locked_state(self):
+        """Yield the bucket state dict with the bucket locked; changes are written back"""
+        with self._thread_lock:
+            with open(self.path, 'a+') as f:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read() or '{}')
+                    except ValueError:
+                        state = {}
+                    now = time.time()
+                    tokens = state.get('tokens', self.capacity)
+                    updated = state.get('updated', now)
+                    state = {
+                        'tokens': min(self.capacity, tokens + max(0.0, now - updated) * self.rate),
+                        'updated': now,
+                    }
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    if fcntl:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if available; return 0 on success or the seconds to wait"""
+        with self._locked_state() as state:
+            if state['tokens'] >= tokens:
+                state['tokens'] -= tokens
+                wait = 0.0
+            else:
+                wait = (tokens - state['tokens']) / self.rate
+            self._publish(state['tokens'], wait)
+            return wait
+
+    def acquire(self, tokens=1, timeout=None):
+        """Block until tokens are available; return the seconds spent waiting"""
+        start = time.time()
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait == 0:
+                waited = time.time() - start
+                metrics.observe('rate_limit_wait_seconds', waited)
+                return waited
+            if timeout is not None and time.time() - start + wait > timeout:
+                raise TimeoutError(f"Rate limit for {self.host} not available within {timeout}s")
+            time.sleep(wait)
+
+    def set_rate(self, rate_per_minute):
+        """Change the refill rate; shared state is untouched"""
+        self.rate = max(rate_per_minute, 0.1) / 60.0
+
+    def status(self):
+        """Return current tokens and the wait for the next request"""
+        with self._locked_state() as state:
+            tokens = state['tokens']
+        wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+        return {'tokens': round(tokens, 3), 'wait_seconds': round(wait, 3), 'rate_per_minute': self.rate * 60}
+
+    def _publish(self, tokens, wait):
+        metrics.set_gauge(f'rate_limit_tokens.{self.host}', round(tokens, 3))
+        metrics.set_gauge(f'rate_limit_wait_seconds.{self.host}', round(wait, 3))
+
+
+class RateLimiter:
+    """Registry of per-host token buckets"""
+
+    def __init__(self, rate_per_minute=RATE_LIMIT_PER_MINUTE, capacity=RATE_LIMIT_BURST, state_dir=RATE_LIMIT_DIR):
+        self.rate_per_minute = rate_per_minute
+        self.capacity = capacity
+        self.state_dir = state_dir
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, url_or_host=None):
+        host = url_or_host or DEFAULT_HOST
+        if '/' in host:
+            host = urlparse(host).netloc or DEFAULT_HOST
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(host, self.rate_per_minute, self.capacity, self.state_dir)
+            return self._buckets[host]
+
+    def acquire(self, url_or_host=None, tokens=1, timeout=None):
+        return self.bucket(url_or_host).acquire(tokens, timeout)
+
+    def set_rate(self, rate_per_minute):
+        """Change the refill rate of every bucket, including ones created later"""
+        with self._lock:
+            self.rate_per_minute = rate_per_minute
+            buckets = list(self._buckets.values())
+        for bucket in buckets:
+            bucket.set_rate(rate_per_minute)
+
+    def status(self):
+        with self._lock:
+            buckets = list(self._buckets.values())
+        return {bucket.host: bucket.status() for bucket in buckets}
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Return the process-wide rate limiter"""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
@@ -0,0 +1,234 @@
+"""
+Retry policy for battle page fetches.
+
+Failures are classified (timeout, not found, driver dead, rate limited, ...)
+and retried with jittered exponential backoff, but only while the URL's and
+the job's time budgets allow it. A process-wide circuit breaker stops every
+worker from hammering tomato.gg while it is failing broadly.
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '3'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '1'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '20'))
+# Seconds one URL may take across all of its attempts
+URL_DEADLINE = float(os.getenv('URL_DEADLINE', '90'))
+# Seconds a whole job may take; URLs not started by then are reported as failed
+JOB_DEADLINE = float(os.getenv('JOB_DEADLINE', '1800'))
+# Consecutive site failures (from any worker) that open the breaker
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '8'))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', '60'))
+
+# Failure classes
+TIMEOUT = 'timeout'
+NOT_FOUND = 'not_found'
+DRIVER_DEAD = 'driver_dead'
+RATE_LIMITED = 'rate_limited'
+NO_DATA = 'no_data'
+ERROR = 'error'
+
+RETRYABLE = (TIMEOUT, DRIVER_DEAD, RATE_LIMITED, ERROR)
+# Failures that say something about the site rather than about one URL or driver
+SITE_FAILURES = (TIMEOUT, RATE_LIMITED, ERROR)
+
+# How a chromedriver that is gone shows up: its local HTTP endpoint refuses or drops the connection
+DRIVER_CONNECTION_ERRORS = (ConnectionError, MaxRetryError, NewConnectionError, ProtocolError)
+DRIVER_DEAD_MARKERS = (
+    'invalid session id', 'no such window', 'chrome not reachable', 'disconnected',
+    'not responsive', 'session deleted', 'target window already closed', 'connection refused',
+)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a URL or job has used up its time budget"""
+
+
+class CircuitOpen(Exception):
+    """Raised when the circuit breaker does not allow a request"""
+
+
+def classify_failure(error):
+    """Map an exception from a page fetch to a failure class
+
+    Rate limiting is only recognised from a failure class the error already
+    carries or from an HTTP 429 status. Exception texts include Chrome's
+    stacktrace addresses, so a "429" in them means nothing.
+    """
+    failure = getattr(error, 'failure', None)
+    if failure is not None:
+        return failure
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None) == 429:
+        return RATE_LIMITED
+    # Checked before timeouts: urllib3's NewConnectionError is a ConnectTimeoutError
+    if isinstance(error, DRIVER_CONNECTION_ERRORS):
+        return DRIVER_DEAD
+    if isinstance(error, (TimeoutException, TimeoutError)):
+        return TIMEOUT
+    message = str(error).lower()
+    if isinstance(error, WebDriverException) and any(marker in message for marker in DRIVER_DEAD_MARKERS):
+        return DRIVER_DEAD
+    return ERROR
+
+
+class Deadline:
+    """A point in time a piece of work has to finish by; budget 0 means none"""
+
+    def __init__(self, budget, parent=None):
+        self.expires_at = time.time() + budget if budget > 0 else None
+        self.parent = parent
+
+    def remaining(self):
+        remaining = float('inf') if self.expires_at is None else self.expires_at - time.time()
+        if self.parent is not None:
+            remaining = min(remaining, self.parent.remaining())
+        return max(0.0, remaining)
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+
+class CircuitBreaker:
+    """Opens after consecutive site failures; lets one probe through after the cooldown"""
+
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        # Thread holding the half-open probe, if any
+        self._probe_owner = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.time() - self._opened_at >= self.cooldown:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        """Return 0 if a request may go out now, else the seconds until it may"""
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return 0
+            if state == 'half_open' and self._probe_owner is None:
+                self._probe_owner = threading.get_ident()
+                return 0
+            if state == 'open':
+                return self._opened_at + self.cooldown - time.time()
+            # While a probe is out the others check back shortly
+            return 1.0
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.warning("Circuit breaker closed, tomato.gg is responding again")
+            self._failures = 0
+            self._opened_at = None
+            self._probe_owner = None
+            metrics.set_gauge('circuit_breaker_open', 0)
+
+    def record_failure(self, failure):
+        with self._lock:
+            if failure not in SITE_FAILURES:
+                # Says nothing about the site; a probe that hit it lets the next one through
+                self._probe_owner = None
+                return
+            self._failures += 1
+            if self._probe_owner is not None or (self._opened_at is None and self._failures >= self.threshold):
+                logger.warning(f"Circuit breaker open after {self._failures} failures, pausing requests for {self.cooldown}s")
+                self._opened_at = time.time()
+                self._probe_owner = None
+                metrics.inc('circuit_breaker_trips')
+                metrics.set_gauge('circuit_breaker_open', 1)
+
+    def release_probe(self):
+        """Give back the probe this thread took without reaching the site, so another one can go out"""
+        with self._lock:
+            if self._probe_owner == threading.get_ident():
+                self._probe_owner = None
+
+    def wait(self, deadline=None):
+        """Block until a request may go out, raising CircuitOpen if the deadline comes first"""
+        while True:
+            wait = self.allow()
+            if wait == 0:
+                return
+            if deadline is not None and deadline.remaining() < wait:
+                raise CircuitOpen(f"Circuit breaker open for another {wait:.0f}s")
+            time.sleep(wait)
+
+
+class RetryPolicy:
+    """Decides whether and when to retry a failed fetch"""
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY, url_budget=URL_DEADLINE, breaker=None):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.url_budget = url_budget
+        self.breaker = breaker
+
+    def url_deadline(self, job_deadline=None):
+        return Deadline(self.url_budget, parent=job_deadline)
+
+    def backoff(self, attempt, failure, retry_after=None):
+        """Seconds to wait before retry number attempt (1-based), with full jitter"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if failure == RATE_LIMITED:
+            delay = max(delay, retry_after or self.base_delay * 2 ** (attempt + 1))
+        return delay
+
+    def next_delay(self, attempt, failure, deadline, retry_after=None):
+        """Return the delay before the next attempt, or None when the fetch should give up"""
+        if failure not in RETRYABLE or attempt >= self.max_attempts:
+            return None
+        delay = self.backoff(attempt, failure, retry_after)
+        if deadline is not None and deadline.remaining() <= delay:
+            return None
+        return delay
+
+    def record(self, failure=None):
+        """Count a fetch outcome and tell the circuit breaker; failure None means success"""
+        if failure is not None:
+            metrics.inc(f'fetch_failures.{failure}')
+        if self.breaker is None:
+            return
+        if failure is None or failure == NOT_FOUND:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure(failure)
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def get_retry_policy():
+    """Return the process-wide retry policy and its circuit breaker"""
+    global _policy
+    with _policy_lock:
+        if _policy is None:
+            _policy = RetryPolicy(breaker=CircuitBreaker())
+        return _policy
@@ -0,0 +1,348 @@
+"""
+Multi-tab battle loading within one Chrome instance.
+
+Instead of loading one page at a time per browser, a worker keeps
+SCRAPER_TABS tabs of a single Chrome busy. It starts a navigation in every
+free tab without waiting for it, then reads whichever tab renders its
+battle first. Parallel page loads then cost one browser's memory rather
+than one browser each. Stored battles, the HTTP fast path, retries,
+deadlines, the circuit breaker and BATTLES_PER_CONTEXT behave as in
+process_battle_chunk.
+"""
+
+import logging
+import os
+import time
+
+import metrics
+from concurrency_controller import get_concurrency_controller
+from battle_fetch import parse_battle_url
+from battle_parser import battle_view, build_scoreboard
+from battle_scraper import (BATTLE_PAGE_CHECK_JS, BATTLES_PER_CONTEXT, BLOCK_RESOURCES, BROWSER_CONTEXTS,
+                            EXTRACTION_MODE, PAGE_READY_TIMEOUT, PERFORMANCE_LOG, REPORT_RESOURCE_STATS,
+                            SCRAPER_TABS, BrowserContextSession, DriverDead, driver_is_alive,
+                            drain_performance_log, enable_resource_blocking, extract_table_html, extract_table_js,
+                            fetch_over_http, quit_driver, rate_limit, record_page_resources, remember_failure,
+                            save_scoreboard, setup_driver, stored_scoreboard)
+from retry_policy import (DRIVER_DEAD, NO_DATA, NOT_FOUND, RATE_LIMITED, TIMEOUT, DeadlineExceeded,
+                          classify_failure, get_retry_policy)
+
+logger = logging.getLogger(__name__)
+
+# Seconds a tab may take from navigation to a rendered battle
+TAB_LOAD_TIMEOUT = float(os.getenv('TAB_LOAD_TIMEOUT', str(30 + PAGE_READY_TIMEOUT)))
+TAB_POLL_INTERVAL = 0.1
+
+# The flag only lives on the page being left, so check() never reads the previous battle
+NAVIGATE_JS = "window.__staleBattlePage = true; window.location.href = arguments[0];"
+POLL_BATTLE_JS = BATTLE_PAGE_CHECK_JS + """
+if (window.__staleBattlePage) {
+    return null;
+}
+return check();
+"""
+
+
+class BattleTab:
+    """One tab of the shared browser, in its own browser context when those are enabled"""
+
+    def __init__(self, driver, home_handle):
+        self.driver = driver
+        self.home_handle = home_handle
+        self.item = None
+        self.started_at = None
+        self.pages = 0
+        self._open()
+
+    def _open(self):
+        self.session = None
+        if BROWSER_CONTEXTS:
+            try:
+                self.session = BrowserContextSession(self.driver)
+                self.handle = self.session.handle
+                return
+            except Exception as e:
+                logger.warning(f"Failed to create browser context for tab, sharing the default one: {str(e)}")
+        self.driver.switch_to.new_window('tab')
+        self.handle = self.driver.current_window_handle
+        if BLOCK_RESOURCES:
+            enable_resource_blocking(self.driver)
+
+    def navigate(self, item):
+        if self.session is not None and self.pages >= BATTLES_PER_CONTEXT:
+            # A fresh context every BATTLES_PER_CONTEXT battles, as on the single-page path
+            self.close()
+            self._open()
+            self.pages = 0
+        self.pages += 1
+        self.item = item
+        self.started_at = time.time()
+        self.driver.switch_to.window(self.handle)
+        self.driver.execute_script(NAVIGATE_JS, item['url'])
+
+    def poll(self):
+        """Return the page state dict once the battle page has settled, else None"""
+        self.driver.switch_to.window(self.handle)
+        return self.driver.execute_script(POLL_BATTLE_JS)
+
+    @property
+    def timed_out(self):
+        return time.time() - self.started_at > TAB_LOAD_TIMEOUT
+
+    def close(self):
+        try:
+            if self.session is not None:
+                self.session.close()
+            else:
+                self.driver.switch_to.window(self.handle)
+                self.driver.close()
+                self.driver.switch_to.window(self.home_handle)
+        except Exception as e:
+            logger.warning(f"Failed to close tab: {str(e)}")
+
+
+def read_tab_scoreboard(driver, item, page_state):
+    """Read the scoreboard from the current tab, whose page_state is 'ready'"""
+    table_data = extract_table_html(driver) if EXTRACTION_MODE == 'html' else extract_table_js(driver)
+    if not table_data:
+        return None
+    result = table_data.get('result') or page_state.get('result') or ''
+    battle_id, player_id = parse_battle_url(item['url'])
+    scoreboard = build_scoreboard(battle_id, player_id, 'win' in result, table_data['tables'])
+    return scoreboard if scoreboard['teams'][0]['battle_data'] else None
+
+
+def process_battle_chunk_tabs(battle_urls_chunk, driver=None, on_result=None, deadline=None, recycle=None,
+                              tabs=SCRAPER_TABS):
+    """Process (index, url) pairs in several tabs of one Chrome instance
+
+    Same contract as battle_scraper.process_battle_chunk, except that results
+    are reported in the order battles finish loading.
+    """
+    chunk_data = []
+    counts = {'victories': 0, 'defeats': 0}
+    policy = get_retry_policy()
+    controller = get_concurrency_controller()
+    source = iter(battle_urls_chunk)
+    retries = []  # items waiting out their backoff
+    state = {'exhausted': False}
+    own_driver = driver is None
+    if own_driver:
+        driver = setup_driver()
+
+    def report(item, scoreboard, error=None):
+        view = battle_view(scoreboard, parse_battle_url(item['url'])[1]) if scoreboard else None
+        is_victory, battle_data = view if view is not None else (None, [])
+        if battle_data:
+            chunk_data.append((item['index'], battle_data))
+            if is_victory is not None:
+                counts['victories' if is_victory else 'defeats'] += 1
+        if on_result:
+            on_result(item['index'], item['url'], is_victory, battle_data, error, scoreboard)
+
+    def next_item():
+        """Return the next battle that needs a browser, settling the others on the way"""
+        while True:
+            now = time.time()
+            due = next((item for item in retries if item['not_before'] <= now), None)
+            if due is not None:
+                retries.remove(due)
+                # The URL deadline includes the job's, so this covers both
+                if due['deadline'].expired:
+                    report(due, None, DeadlineExceeded("Deadline passed before the battle could be retried"))
+                    continue
+                return due
+            # Asked again every time: the source may be a work queue that refills
+            pair = next(source, None)
+            state['exhausted'] = pair is None
+            if pair is None:
+                return None
+            item = {'index': pair[0], 'url': pair[1], 'attempt': 1, 'not_before': 0}
+            if deadline is not None and deadline.expired:
+                report(item, None, DeadlineExceeded("Job deadline passed before the battle was fetched"))
+                continue
+            found, scoreboard = stored_scoreboard(item['url'])
+            if found:
+                report(item, scoreboard)
+                continue
+            item['deadline'] = policy.url_deadline(deadline)
+            try:
+                scoreboard = fetch_over_http(item['url'], policy, item['deadline'])
+            except Exception as e:
+                # CircuitOpen: the breaker stays open past the battle's deadline
+                logger.error(f"Error processing battle {item['url']}: {str(e)}")
+                report(item, None, e)
+                continue
+            if scoreboard is not None:
+                save_scoreboard(item['url'], scoreboard)
+                report(item, scoreboard)
+                continue
+            return item
+
+    def finish(tab, scoreboard=None, failure=None, error=None):
+        item, tab.item = tab.item, None
+        controller.release()
+        controller.record(time.time() - tab.started_at if failure is None else None, failure)
+        # Every tab shares the driver's performance log; emptying it as pages finish keeps it from growing,
+        # and the events since the last finished page are counted for this one
+        if failure is None and BLOCK_RESOURCES and REPORT_RESOURCE_STATS:
+            record_page_resources(driver, item['url'])
+        elif PERFORMANCE_LOG:
+            drain_performance_log(driver)
+        if failure is None:
+            policy.record()
+            save_scoreboard(item['url'], scoreboard)
+            metrics.inc('tab_pages_loaded')
+            report(item, scoreboard)
+            return
+        policy.record(failure)
+        delay = policy.next_delay(item['attempt'], failure, item['deadline'])
+        if delay is not None:
+            logger.warning(f"Attempt {item['attempt']} failed for {item['url']} ({failure}), retrying in {delay:.1f}s: {str(error)}")
+            item['attempt'] += 1
+            item['not_before'] = time.time() + delay
+            retries.append(item)
+            return
+        if failure in (NOT_FOUND, NO_DATA):
+            logger.warning(f"Giving up on {item['url']} ({failure}): {str(error)}")
+            # An empty table may just have rendered late, so only error pages are remembered
+            if failure == NOT_FOUND:
+                remember_failure(item['url'], failure)
+        else:
+            logger.error(f"Giving up on {item['url']} after {item['attempt']} attempt(s) ({failure}): {str(error)}")
+        report(item, None)
+
+    def open_tabs(driver):
+        home_handle = driver.current_window_handle
+        return home_handle, [BattleTab(driver, home_handle) for _ in range(max(1, tabs))]
+
+    def abandon_tabs(open_tabs):
+        """Put battles still loading back in line; their tabs went with the old driver"""
+        for tab in open_tabs:
+            if tab.item is not None:
+                tab.item['not_before'] = 0
+                retries.append(tab.item)
+                tab.item = None
+                controller.release()
+        # A probe that went out with the old driver never got an answer
+        policy.breaker.release_probe()
+
+    def start_navigations():
+        """Start a navigation in every free tab; return True if the driver died doing so"""
+        for tab in battle_tabs:
+            if tab.item is not None:
+                continue
+            # A tab loading a battle holds one of the controller's page load slots
+            if not controller.try_acquire():
+                return False
+            item = next_item()
+            if item is None:
+                controller.release()
+                return False
+            # Asked only now that a page will really be loaded, so a half-open probe is always used
+            if policy.breaker.allow() != 0:
+                retries.insert(0, item)
+                controller.release()
+                return False
+            try:
+                rate_limit(item['url'])
+                logger.warning(f"Loading battle {item['url']} in a tab (Attempt {item['attempt']})")
+                tab.navigate(item)
+            except Exception as e:
+                tab.item = item
+                failure = classify_failure(e)
+                if failure == DRIVER_DEAD and not driver_is_alive(driver):
+                    return True
+                finish(tab, failure=failure, error=e)
+        return False
+
+    home_handle, battle_tabs = open_tabs(driver)
+    try:
+        while True:
+            dead = start_navigations()
+
+            loading = [tab for tab in battle_tabs if tab.item is not None]
+            if not loading and not dead:
+                if state['exhausted'] and not retries:
+                    break
+                time.sleep(TAB_POLL_INTERVAL)
+                continue
+
+            # Read whichever tabs have settled
+            finished = 0
+            for tab in loading if not dead else []:
+                try:
+                    page_state = tab.poll()
+                    if page_state is None:
+                        if tab.timed_out:
+                            finish(tab, failure=TIMEOUT, error=f"Battle did not render within {TAB_LOAD_TIMEOUT:.0f}s")
+                            finished += 1
+                        continue
+                    finished += 1
+                    if page_state['state'] == 'error':
+                        finish(tab, failure=NOT_FOUND, error=f"Error page detected: {page_state.get('reason')}")
+                    elif page_state['state'] == 'rate_limited':
+                        finish(tab, failure=RATE_LIMITED, error=f"Rate limited page: {page_state.get('reason')}")
+                    else:
+                        scoreboard = read_tab_scoreboard(driver, tab.item, page_state)
+                        if scoreboard is None:
+                            finish(tab, failure=NO_DATA, error="No valid battle data found in table")
+                        else:
+                            finish(tab, scoreboard)
+                except Exception as e:
+                    failure = classify_failure(e)
+                    if failure == DRIVER_DEAD and not driver_is_alive(driver):
+                        dead = True
+                        break
+                    finish(tab, failure=failure, error=e)
+                    finished += 1
+
+            if dead:
+                abandon_tabs(battle_tabs)
+                if recycle is None and not own_driver:
+                    raise DriverDead("Driver died while loading battles in tabs")
+                logger.warning("Driver died while loading battles in tabs, continuing on a fresh driver")
+                if recycle is not None:
+                    driver = recycle(driver, dead=True)
+                else:
+                    quit_driver(driver)
+                    driver = setup_driver()
+                home_handle, battle_tabs = open_tabs(driver)
+                continue
+
+            for _ in range(finished if recycle is not None else 0):
+                # Every finished page counts towards recycling; a fresh driver needs fresh tabs
+                new_driver = recycle(driver)
+                if new_driver is not driver:
+                    abandon_tabs(battle_tabs)
+                    driver = new_driver
+                    home_handle, battle_tabs = open_tabs(driver)
+                    break
+            if not finished:
+                time.sleep(TAB_POLL_INTERVAL)
+    except Exception as e:
+        # Battles already taken from the queue would otherwise never be reported
+        for tab in battle_tabs:
+            if tab.item is not None:
+                retries.append(tab.item)
+                tab.item = None
+                controller.release()
+        policy.breaker.release_probe()
+        for item in retries:
+            report(item, None, e)
+        retries.clear()
+        raise
+    finally:
+        if driver is not None:
+            for tab in battle_tabs:
+                if tab.item is not None:
+                    controller.release()
+                tab.close()
+            try:
+                driver.switch_to.window(home_handle)
+            except Exception:
+                pass
+            if own_driver:
+                quit_driver(driver)
+
+    return chunk_data, counts['victories'], counts['defeats']